@@ -1,19 +1,15 @@
-from langgraph.graph import StateGraph, END
-from planner import planner_node
-from developer import developer_node
-from state import AgentState
+import asyncio
+import threading
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
-# Create graph with state schema TYPE
-graph = StateGraph(AgentState)
+# Every run is checkpointed per session so it can be resumed, retried or rolled back
+SESSION_DB = os.getenv("AGENT_SESSION_DB", "sessions.sqlite3")
 
-graph.add_node('planner', planner_node)
-graph.add_node('developer', developer_node)
-
-# Set the entry point
-graph.set_entry_point("planner")
+# langgraph.graph.END; LangGraph is only imported once the graph is built
+END = "__end__"
 
 def should_continue_to_developer(state):
     """Check if planner is done and has no errors"""
@@ -41,15 +37,63 @@ def should_continue_developer(state):
     logger.info("Developer continuing")
     return "developer"
 
-# Add conditional edges
-graph.add_conditional_edges(
-    "planner",
-    should_continue_to_developer
-)
+_graph = None
+_graph_lock = threading.Lock()
+
+def get_graph():
+    """The uncompiled agent graph, built on first use"""
+    # LangGraph, LangChain and the provider SDKs behind the nodes take most of the
+    # process's start-up time, so importing this module doesn't pull them in
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            from langgraph.graph import StateGraph
+            from planner import planner_node
+            from developer import developer_node
+            from state import AgentState
+            from metrics import timed_node
+
+            # Create graph with state schema TYPE
+            graph = StateGraph(AgentState)
+
+            graph.add_node('planner', timed_node('planner', planner_node))
+            graph.add_node('developer', timed_node('developer', developer_node))
+
+            # Set the entry point
+            graph.set_entry_point("planner")
+
+            # Add conditional edges
+            graph.add_conditional_edges(
+                "planner",
+                should_continue_to_developer
+            )
+
+            graph.add_conditional_edges(
+                "developer", 
+                should_continue_developer
+            )
+            _graph = graph
+    return _graph
+
+_compiled = None
 
-graph.add_conditional_edges(
-    "developer", 
-    should_continue_developer
-)
+async def get_compiled():
+    """Graph compiled with the session checkpointer, built on first use"""
+    # The async saver binds to the running event loop, so it can't be created at import
+    global _compiled
+    if _compiled is None:
+        # Imports run in a thread so the event loop keeps answering while they load
+        graph = await asyncio.to_thread(get_graph)
+        if _compiled is None:
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+            import aiosqlite
+            checkpointer = AsyncSqliteSaver(aiosqlite.connect(SESSION_DB))
+            _compiled = graph.compile(checkpointer=checkpointer)
+    return _compiled
 
-compiled = graph.compile()
\ No newline at end of file
+async def close_compiled():
+    """Close the session database connection"""
+    global _compiled
+    if _compiled is not None:
+        await _compiled.checkpointer.conn.close()
+        _compiled = None
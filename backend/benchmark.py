@@ -0,0 +1,248 @@
+"""Offline benchmark of the agent pipeline's non-LLM overhead
+
+Runs against the deterministic fake LLM (fake_llm.py), so no network or API key is needed:
+
+    python benchmark.py --sizes 100 1000 10000 --steps 2 4 --concurrency 1 8
+    python benchmark.py --target server --output before.json
+    python benchmark.py --baseline before.json --tolerance 0.2
+    python benchmark.py --micro
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+# Must be set before the pipeline modules are imported
+os.environ["AGENT_LLM"] = "fake"
+# Every request repeats the same task, so stored plans would skip the planner entirely
+os.environ.setdefault("PLAN_STORE", "off")
+os.environ.setdefault("AGENT_SESSION_DB", os.path.join(tempfile.mkdtemp(prefix="agent-bench-"), "sessions.sqlite3"))
+
+import logging
+logging.disable(logging.WARNING)
+
+from tools import llm, apply_diff, extract_diff, search_internal
+from state import AgentState, as_agent_state
+import agent_graph
+
+def make_code(lines: int) -> str:
+    """Synthetic, parseable module of roughly `lines` lines made of small top-level functions"""
+    out = ["import os", "import sys", "", "CONFIG = {'debug': False}", ""]
+    i = 0
+    while len(out) < lines:
+        out.extend([
+            "",
+            f"def handler_{i:05d}(value, scale=2):",
+            f"    if value is None:",
+            f"        return CONFIG.get('default_{i}', 0)",
+            f"    result = value * scale + {i}",
+            f"    if result > {i * 10}:",
+            f"        result -= {i}",
+            f"    return result",
+        ])
+        i += 1
+    return "\n".join(out) + "\n"
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def graph_runner():
+    # Checkpoint-free graph: just planner, developer and state handling
+    compiled = agent_graph.get_graph().compile()
+
+    async def run(code: str) -> AgentState:
+        values = await compiled.ainvoke({
+            'planner': {'user_task': 'Document the handlers'},
+            'developer': {},
+            'code_history': [code]
+        })
+        state = as_agent_state(values)
+        error = state.planner.error or state.developer.error
+        if error:
+            raise RuntimeError(error)
+        return state
+
+    return run, None
+
+def server_runner():
+    # Full request path: FastAPI, limiter, checkpointer and response building
+    import httpx
+    import server
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench")
+
+    async def run(code: str) -> dict:
+        response = await client.post('/agent', json={'code': code, 'instruction': 'Document the handlers'})
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    return run, client.aclose
+
+async def run_scenario(run, code: str, requests: int, concurrency: int) -> dict:
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await run(code)
+            except Exception as e:
+                failures += 1
+                logging.getLogger(__name__).error(f"Benchmark request failed: {e}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    wall = time.perf_counter() - start
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'throughput_rps': round(requests / wall, 2),
+        'failures': failures
+    }
+
+async def peak_memory(run, code: str) -> float:
+    """Peak traced allocation of one request in MiB (measured apart from the timings)"""
+    tracemalloc.start()
+    try:
+        await run(code)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 2 ** 20, 2)
+
+async def run_pipeline(args) -> List[dict]:
+    run, close = server_runner() if args.target == 'server' else graph_runner()
+    fakes = [client.model for client in llm.clients.values()]
+    for fake in fakes:
+        fake.latency = args.latency
+    results = []
+    try:
+        for size in args.sizes:
+            code = make_code(size)
+            for steps in args.steps:
+                for fake in fakes:
+                    fake.plan_steps = steps
+                for _ in range(args.warmup):
+                    await run(code)
+                memory = await peak_memory(run, code) if args.memory else None
+                for concurrency in args.concurrency:
+                    requests = max(args.requests, concurrency)
+                    result = await run_scenario(run, code, requests, concurrency)
+                    result.update({
+                        'name': f"{args.target} lines={size} steps={steps} concurrency={concurrency}",
+                        'peak_mib': memory
+                    })
+                    results.append(result)
+                    print_row(result)
+    finally:
+        if close:
+            await close()
+        await agent_graph.close_compiled()
+    return results
+
+def timed(fn, repeat: int) -> float:
+    """Mean microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def run_micro(args) -> List[dict]:
+    """Per-call cost of the helpers the pipeline runs for every step"""
+    results = []
+    for size in args.sizes:
+        code = make_code(size)
+        lines = code.split('\n')
+        middle = next(i for i in range(len(lines) // 2, len(lines)) if lines[i].startswith('def '))
+        name = lines[middle][4:lines[middle].index('(')]
+        response = (
+            "```diff\n--- original.py\n+++ modified.py\n"
+            f"@@ -{middle + 1},1 +{middle + 1},2 @@\n {lines[middle]}\n+    \"\"\"Doc.\"\"\"\n```"
+        )
+        diff = extract_diff(response)
+        history = [code, apply_diff(code, diff)]
+        event = AgentState.model_validate({
+            'planner': {'user_task': 'task', 'plan_steps': ['a', 'b'], 'planner_done': True},
+            'developer': {'plan_steps': ['a', 'b'], 'current_idx': 1},
+            'code_history': history
+        })
+
+        for label, fn in (
+            ('extract_diff', lambda: extract_diff(response)),
+            ('apply_diff', lambda: apply_diff(code, diff)),
+            ('search_internal', lambda: search_internal(f"Update {name}", code)),
+            ('state_round_trip', lambda: AgentState.model_validate(event.model_dump())),
+        ):
+            result = {'name': f"micro {label} lines={size}", 'mean_us': round(timed(fn, args.repeat), 2)}
+            results.append(result)
+            print_row(result)
+    return results
+
+def print_row(result: dict):
+    fields = "  ".join(f"{key}={value}" for key, value in result.items() if key != 'name' and value is not None)
+    print(f"{result['name']:<52} {fields}", flush=True)
+
+def compare(results: List[dict], baseline_path: str, tolerance: float) -> List[str]:
+    """Scenarios whose latency grew by more than tolerance over the baseline"""
+    with open(baseline_path) as f:
+        baseline = {entry['name']: entry for entry in json.load(f)}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        key = 'mean_us' if 'mean_us' in result else 'p50_ms'
+        if before[key] and result[key] > before[key] * (1 + tolerance):
+            regressions.append(f"{result['name']}: {key} {before[key]} -> {result[key]}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline against a fake LLM")
+    parser.add_argument('--target', choices=('graph', 'server'), default='graph',
+                        help="drive the compiled graph directly or the /agent endpoint")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help="file sizes in lines")
+    parser.add_argument('--steps', type=int, nargs='+', default=[3], help="plan lengths")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8], help="concurrent requests")
+    parser.add_argument('--requests', type=int, default=20, help="requests per scenario")
+    parser.add_argument('--warmup', type=int, default=1, help="unmeasured requests before each scenario")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip the peak memory pass")
+    parser.add_argument('--micro', action='store_true', help="time diff, search and state helpers instead")
+    parser.add_argument('--repeat', type=int, default=200, help="calls per micro benchmark")
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown over the baseline")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = run_micro(args) if args.micro else asyncio.run(run_pipeline(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if any(result.get('failures') for result in results):
+        print("Some requests failed", file=sys.stderr)
+        return 1
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+import ast
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from patcher import PatchResult
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Longest snippet returned for a single symbol
+MAX_SNIPPET_LINES = 40
+
+# Number of code versions whose index is kept around
+MAX_CACHED_INDEXES = 64
+
+# Plain dataclasses rather than pydantic models: thousands of these are
+# re-created on every incremental update and they are never serialized
+@dataclass
+class Symbol:
+    name: str
+    kind: str  # function, method, class, import, assignment
+    start: int  # 1-based, inclusive (decorators included)
+    end: int
+    parent: Optional[str] = None
+
+    @property
+    def qualname(self) -> str:
+        return f"{self.parent}.{self.name}" if self.parent else self.name
+
+@dataclass
+class Reference:
+    name: str
+    line: int
+    caller: Optional[str] = None  # Qualified name of the enclosing def, None at module level
+
+@dataclass
+class Block:
+    """One top-level statement and everything defined or called inside it"""
+    start: int
+    end: int
+    symbols: List[Symbol] = field(default_factory=list)
+    references: List[Reference] = field(default_factory=list)
+
+    def shifted(self, delta: int) -> "Block":
+        if delta == 0:
+            return self
+        return Block(
+            self.start + delta,
+            self.end + delta,
+            [Symbol(s.name, s.kind, s.start + delta, s.end + delta, s.parent) for s in self.symbols],
+            [Reference(r.name, r.line + delta, r.caller) for r in self.references]
+        )
+
+class _BlockVisitor(ast.NodeVisitor):
+    def __init__(self, block: Block):
+        self.block = block
+        self.scope: List[str] = []  # Enclosing def/class names
+        self.in_class: List[bool] = []
+
+    def _def(self, node, kind):
+        start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+        self.block.symbols.append(Symbol(
+            name=node.name,
+            kind=kind,
+            start=start,
+            end=node.end_lineno,
+            parent='.'.join(self.scope) or None
+        ))
+        self.scope.append(node.name)
+        self.in_class.append(kind == 'class')
+        self.generic_visit(node)
+        self.scope.pop()
+        self.in_class.pop()
+
+    def visit_FunctionDef(self, node):
+        self._def(node, 'method' if self.in_class and self.in_class[-1] else 'function')
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self._def(node, 'class')
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.block.symbols.append(Symbol(
+                name=(alias.asname or alias.name).split('.')[0],
+                kind='import',
+                start=node.lineno,
+                end=node.end_lineno,
+                parent='.'.join(self.scope) or None
+            ))
+
+    visit_ImportFrom = visit_Import
+
+    def _assign(self, node, targets):
+        # Only module and class level assignments are worth indexing
+        if not self.scope or self.in_class[-1]:
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        self.block.symbols.append(Symbol(
+                            name=name.id,
+                            kind='assignment',
+                            start=node.lineno,
+                            end=node.end_lineno,
+                            parent='.'.join(self.scope) or None
+                        ))
+        self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        self._assign(node, node.targets)
+
+    def visit_AnnAssign(self, node):
+        self._assign(node, [node.target])
+
+    def visit_Call(self, node):
+        func = node.func
+        name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+        if name:
+            self.block.references.append(Reference(
+                name=name,
+                line=node.lineno,
+                caller='.'.join(self.scope) or None
+            ))
+        self.generic_visit(node)
+
+def _parse_blocks(source: str, line_offset: int = 0) -> List[Block]:
+    tree = ast.parse(source)
+    if line_offset:
+        ast.increment_lineno(tree, line_offset)
+
+    blocks = []
+    for node in tree.body:
+        decorators = getattr(node, 'decorator_list', [])
+        block = Block(
+            start=min([d.lineno for d in decorators] + [node.lineno]),
+            end=node.end_lineno
+        )
+        _BlockVisitor(block).visit(node)
+        blocks.append(block)
+    return blocks
+
+class CodeIndex:
+    """Symbol index for one version of the code"""
+
+    def __init__(self, code: str, blocks: Optional[List[Block]] = None):
+        self.code = code
+        self.lines = code.split('\n')
+        self.valid = True
+        if blocks is None:
+            try:
+                blocks = _parse_blocks(code)
+            except SyntaxError as e:
+                logger.info(f"Code does not parse, index is empty: {e}")
+                blocks = []
+                self.valid = False
+        self.blocks = blocks
+        self._by_name: Dict[str, List[Symbol]] = {}
+        self._refs_by_name: Dict[str, List[Reference]] = {}
+        for block in blocks:
+            for symbol in block.symbols:
+                self._by_name.setdefault(symbol.name.lower(), []).append(symbol)
+            for ref in block.references:
+                self._refs_by_name.setdefault(ref.name.lower(), []).append(ref)
+
+    @property
+    def symbols(self) -> List[Symbol]:
+        return [symbol for block in self.blocks for symbol in block.symbols]
+
+    def lookup(self, name: str) -> List[Symbol]:
+        return self._by_name.get(name.lower(), [])
+
+    def references_to(self, name: str) -> List[Reference]:
+        return self._refs_by_name.get(name.lower(), [])
+
+    def block_of(self) -> Dict[str, int]:
+        """Map every def/class name to the index of its top-level block"""
+        mapping = {}
+        for i, block in enumerate(self.blocks):
+            for symbol in block.symbols:
+                if symbol.kind in ('function', 'method', 'class'):
+                    mapping.setdefault(symbol.name, i)
+        return mapping
+
+    def snippet(self, symbol: Symbol) -> str:
+        end = min(symbol.end, symbol.start + MAX_SNIPPET_LINES - 1)
+        text = '\n'.join(self.lines[symbol.start - 1:end])
+        if end < symbol.end:
+            text += f"\n    ... ({symbol.end - end} more lines)"
+        return text
+
+    def search(self, query: str, limit: int = 5) -> List[str]:
+        """Snippets for the symbols a query names, with their call sites"""
+        terms = {term.lower() for term in re.findall(r'[A-Za-z_]\w*', query) if len(term) > 2}
+        matches = []
+        seen = set()
+        for term in terms:
+            for symbol in self.lookup(term):
+                key = (symbol.start, symbol.name)
+                if key not in seen:
+                    seen.add(key)
+                    matches.append(symbol)
+
+        # Definitions first, in file order
+        matches.sort(key=lambda s: (s.kind in ('import', 'assignment'), s.start))
+        results = []
+        for symbol in matches[:limit]:
+            text = f"{symbol.kind} {symbol.qualname} (lines {symbol.start}-{symbol.end}):\n{self.snippet(symbol)}"
+            callers = [
+                f"{ref.caller or '<module>'} (line {ref.line})"
+                for ref in self.references_to(symbol.name)
+            ]
+            if callers:
+                text += f"\nCalled from: {', '.join(callers[:10])}"
+            results.append(text)
+        return results
+
+    def apply_patch(self, patch: PatchResult) -> "CodeIndex":
+        """Index for patch.code, re-parsing only the top-level blocks the patch touched"""
+        applied = [h for h in patch.hunks if h.applied]
+        if patch.replaced or not self.valid or not applied:
+            return CodeIndex(patch.code)
+
+        # Changed region of the old code, 1-based inclusive
+        first = min(h.start for h in applied) + 1
+        last = max(h.start + max(h.old_len, 1) for h in applied)
+        delta = sum(h.new_len - h.old_len for h in applied)
+
+        before = [i for i, b in enumerate(self.blocks) if b.start <= first]
+        after = [i for i, b in enumerate(self.blocks) if b.end >= last]
+        a = before[-1] if before else 0
+        b = after[0] if after else len(self.blocks) - 1
+        if not self.blocks or b < a:
+            return CodeIndex(patch.code)
+
+        region_start = min(self.blocks[a].start, first) if before else 1
+        region_end = self.blocks[b].end + delta if after else len(patch.code.split('\n'))
+        new_lines = patch.code.split('\n')
+        try:
+            reparsed = _parse_blocks('\n'.join(new_lines[region_start - 1:region_end]), region_start - 1)
+        except SyntaxError:
+            return CodeIndex(patch.code)
+
+        keep_before = self.blocks[:a] if before else []
+        keep_after = [block.shifted(delta) for block in self.blocks[b + 1:]] if after else []
+        return CodeIndex(patch.code, keep_before + reparsed + keep_after)
+
+_indexes: "OrderedDict[str, CodeIndex]" = OrderedDict()
+
+def _code_key(code: str) -> str:
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+def _remember(key: str, index: CodeIndex) -> CodeIndex:
+    _indexes[key] = index
+    _indexes.move_to_end(key)
+    while len(_indexes) > MAX_CACHED_INDEXES:
+        _indexes.popitem(last=False)
+    return index
+
+def get_index(code: str) -> CodeIndex:
+    """Index for a code version, built on first use"""
+    key = _code_key(code)
+    index = _indexes.get(key)
+    if index is not None:
+        _indexes.move_to_end(key)
+        return index
+    return _remember(key, CodeIndex(code))
+
+def update_index(base_code: str, patch: PatchResult) -> Optional[CodeIndex]:
+    """Derive the index of patch.code from the cached index of base_code"""
+    base = _indexes.get(_code_key(base_code))
+    if base is None:
+        return None  # Built lazily if anyone asks for it
+    new_key = _code_key(patch.code)
+    if new_key in _indexes:
+        return _indexes[new_key]
+    return _remember(new_key, base.apply_patch(patch))
@@ -0,0 +1,153 @@
+import os
+import re
+from typing import List, Optional, Tuple
+from pydantic import BaseModel
+from code_index import get_index
+from patcher import HUNK_HEADER
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio used for budgeting prompts
+CHARS_PER_TOKEN = 4
+
+# Token budget for the code shown to the developer for one step
+DEV_CONTEXT_TOKENS = int(os.getenv("DEV_CONTEXT_TOKENS", "4000"))
+
+# Lines of surrounding code kept around each call site and at the end of the file
+CALL_SITE_CONTEXT = 2
+TAIL_LINES = 5
+
+# Call sites of the step's symbols worth showing
+MAX_CALL_SITES = 10
+
+# Outline entries listed per omitted region
+MAX_OUTLINE_ENTRIES = 20
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+class CodeWindow(BaseModel):
+    """The view of a file sent to the LLM and how its lines map back to the file"""
+    text: str
+    segments: List[Tuple[int, int, int]] = []  # (view_start, file_start, length), 1-based
+    windowed: bool = False
+
+    def to_file_line(self, view_line: int) -> int:
+        """File line for a view line; marker lines map to the next shown line"""
+        for view_start, file_start, length in self.segments:
+            if view_line < view_start:
+                return file_start
+            if view_line < view_start + length:
+                return file_start + (view_line - view_start)
+        last_view, last_file, last_len = self.segments[-1]
+        return last_file + last_len + max(0, view_line - (last_view + last_len))
+
+    def reanchor(self, diff: str) -> str:
+        """Rewrite hunk headers from view line numbers to file line numbers"""
+        if not self.windowed:
+            return diff
+
+        def fix(line: str) -> str:
+            match = HUNK_HEADER.match(line)
+            if not match:
+                return line
+            old_start = int(match.group(1))
+            new_start = int(match.group(3))
+            file_start = self.to_file_line(max(old_start, 1))
+            shift = file_start - old_start
+            old_len = f",{match.group(2)}" if match.group(2) is not None else ""
+            new_len = f",{match.group(4)}" if match.group(4) is not None else ""
+            return f"@@ -{file_start}{old_len} +{new_start + shift}{new_len} @@" + line[match.end():]
+
+        return '\n'.join(fix(line) for line in diff.split('\n'))
+
+def _merge(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _size(lines: List[str], ranges: List[Tuple[int, int]]) -> int:
+    return sum(len(line) + 1 for start, end in _merge(ranges) for line in lines[start - 1:end])
+
+def _signature(lines: List[str], symbol) -> str:
+    """The def/class line of a symbol, skipping its decorators"""
+    for line in lines[symbol.start - 1:symbol.end]:
+        if line.lstrip().startswith(('def ', 'async def ', 'class ')):
+            return line.strip()
+    return lines[symbol.start - 1].strip()
+
+def build_window(code: str, step: str, budget_tokens: Optional[int] = None) -> CodeWindow:
+    """Show the regions relevant to a step plus an outline of the rest, within a token budget"""
+    budget_tokens = budget_tokens or DEV_CONTEXT_TOKENS
+    lines = code.split('\n')
+    if estimate_tokens(code) <= budget_tokens:
+        return CodeWindow(text=code, segments=[(1, 1, len(lines))])
+
+    index = get_index(code)
+    n = len(lines)
+    budget_chars = budget_tokens * CHARS_PER_TOKEN
+
+    # Candidate ranges in priority order
+    candidates: List[Tuple[int, int]] = []
+    terms = {term.lower() for term in re.findall(r'[A-Za-z_]\w*', step) if len(term) > 2}
+    matched = [symbol for term in terms for symbol in index.lookup(term)]
+    for symbol in sorted(matched, key=lambda s: s.start):
+        # Whole top-level statement when it fits comfortably, else just the symbol
+        block = next((b for b in index.blocks if b.start <= symbol.start <= b.end), None)
+        if block and _size(lines, [(block.start, block.end)]) <= budget_chars // 2:
+            candidates.append((block.start, block.end))
+        else:
+            candidates.append((symbol.start, symbol.end))
+
+    # Module header (imports, constants) up to the first def/class
+    first_def = next(
+        (s.start for s in index.symbols if s.kind in ('function', 'class')),
+        n + 1
+    )
+    candidates.append((1, min(first_def - 1, 30)))
+    candidates.append((max(1, n - TAIL_LINES + 1), n))
+
+    for symbol in matched:
+        for ref in index.references_to(symbol.name)[:MAX_CALL_SITES]:
+            candidates.append((max(1, ref.line - CALL_SITE_CONTEXT), min(n, ref.line + CALL_SITE_CONTEXT)))
+
+    # Keep the outline's share of the budget free
+    reserve = budget_chars // 5
+    chosen: List[Tuple[int, int]] = []
+    for start, end in candidates:
+        if start > end:
+            continue
+        if _size(lines, chosen + [(start, end)]) <= budget_chars - reserve:
+            chosen.append((start, end))
+    if not chosen:
+        chosen = [(max(1, n - TAIL_LINES + 1), n)]
+
+    # Render shown regions, replacing each gap with an outline of what it defines
+    top_level = [s for s in index.symbols if s.parent is None and s.kind in ('function', 'class')]
+    view: List[str] = []
+    segments = []
+    previous_end = 0
+    for start, end in _merge(chosen) + [(n + 1, n)]:
+        if start > previous_end + 1:
+            gap_start, gap_end = previous_end + 1, start - 1
+            outline = [_signature(lines, s) for s in top_level if gap_start <= s.start <= gap_end]
+            view.append(f"# ... lines {gap_start}-{gap_end} omitted" + ("; they define:" if outline else ""))
+            view.extend(f"#     {entry}" for entry in outline[:MAX_OUTLINE_ENTRIES])
+            if len(outline) > MAX_OUTLINE_ENTRIES:
+                view.append(f"#     ... and {len(outline) - MAX_OUTLINE_ENTRIES} more")
+        if start <= n:
+            segments.append((len(view) + 1, start, end - start + 1))
+            view.extend(lines[start - 1:end])
+        previous_end = end
+
+    text = '\n'.join(view)
+    logger.info(
+        f"Context window for step: {len(segments)} region(s), "
+        f"~{estimate_tokens(text)} of ~{estimate_tokens(code)} tokens"
+    )
+    return CodeWindow(text=text, segments=segments, windowed=True)
@@ -1,102 +1,392 @@
-from tools import search_internal, search_external, apply_diff, llm, extract_diff
-from langchain_core.messages import SystemMessage, HumanMessage
+from tools import search_internal, search_external, llm
+from patcher import apply_patch, PatchError, PatchResult
+from scheduler import plan_batch, step_regions
+from code_index import get_index, update_index
+from context import build_window
+from edit_formats import EditFormatError, choose_format, size_class, history as edit_history
+from metrics import span, record_llm_usage, SPECULATIVE_DRAFTS
+from sandbox import get_pool, syntax_error
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from state import DeveloperState, AgentState
+from history import NewVersions
+from workspace import Tree, WorkspaceChanges, file_diff, get_blob_store, rank_files, read, step_target
+from typing import Awaitable, Callable, Optional, Set, Tuple
+import speculation
+import asyncio
 import logging
+import os
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-def developer_node(state: AgentState) -> AgentState:
+# LLM attempts per step when the generated diff does not apply cleanly
+MAX_PATCH_ATTEMPTS = int(os.getenv("DEV_PATCH_ATTEMPTS", "2"))
+
+# Upper bound on independent steps whose diffs are generated concurrently
+MAX_PARALLEL_STEPS = int(os.getenv("DEV_MAX_PARALLEL_STEPS", "4"))
+
+# Steps drafted while the plan is still streaming (0 disables speculation)
+SPECULATIVE_STEPS = int(os.getenv("DEV_SPECULATIVE_STEPS", str(MAX_PARALLEL_STEPS)))
+
+# Definitions from other files shown with a workspace step, in tokens (~4 characters each)
+WORKSPACE_RELATED_TOKENS = int(os.getenv("WORKSPACE_RELATED_TOKENS", "1500"))
+
+# Sandbox outcomes that mean the code itself failed to run
+RUN_FAILURES = ('run', 'timeout', 'limits')
+
+Validator = Callable[[str], Awaitable[Optional[str]]]
+
+async def make_validator(code: str, developer: DeveloperState, final: bool) -> Optional[Validator]:
+    """Sandbox check for a step's result, or None when execution checks are off"""
+    if not (developer.run_code or developer.tests):
+        return None
+    pool = await get_pool()
+    with span("sandbox"):
+        before = await pool.run(code, developer.tests)
+    # A step is only held to what already worked before it
+    must_run = before.stage not in RUN_FAILURES
+    passing = set(before.passed)
+    
+    async def validate(new_code: str) -> Optional[str]:
+        with span("sandbox"):
+            result = await pool.run(new_code, developer.tests)
+        if result.stage == 'sandbox':
+            logger.warning(f"Skipping execution check: {result.error}")
+            return None
+        if result.stage in RUN_FAILURES:
+            return f"Running the patched code failed:\n{result.describe()}" if must_run else None
+        if not developer.tests or result.ok:
+            return None
+        if final:
+            return f"The tests do not pass after the final step:\n{result.describe()}"
+        # Earlier steps may leave tests for later steps failing, but must not break passing ones
+        broken = sorted(passing - set(result.passed))
+        if broken:
+            return "This step broke tests that passed before it:\n" + "\n".join(
+                f"{name} failed:\n{result.failed.get(name) or result.error}" for name in broken
+            )
+        return None
+    
+    return validate
+
+async def check_patch(base_code: str, patch: PatchResult, validate: Optional[Validator]) -> Optional[str]:
+    """Why a cleanly applied patch is still unacceptable, or None"""
+    # Only hold the step to parsing if the code parsed before it
+    if get_index(base_code).valid:
+        with span("syntax_check"):
+            index = update_index(base_code, patch) or get_index(patch.code)
+        if not index.valid:
+            error = syntax_error(patch.code)
+            if error:
+                return f"The patched code does not parse: {error}"
+    if validate is not None:
+        return await validate(patch.code)
+    return None
+
+async def generate_step_patch(step: str, current_code: str,
+                              validate: Optional[Validator] = None,
+                              path: Optional[str] = None, related: str = "") -> Tuple[str, PatchResult]:
+    """Ask the LLM for an edit implementing one step and apply it to current_code
+
+    Workspace steps pass the file's path and related code from other files.
+    """
+    # Large files are shown as the regions relevant to the step plus an outline
+    with span("context_window"):
+        window = build_window(current_code, step)
+    fmt = choose_format(current_code, step)
+    if window.windowed:
+        code_context = (
+            "Only the parts of the file relevant to this step are shown. Lines starting with "
+            "'# ... lines' stand for omitted code; never include them in your edits. "
+            f"{fmt.window_note}\n"
+        )
+    else:
+        with span("search_internal"):
+            code_context = f"Internal Context: {search_internal(step, current_code)}\n"
+    
+    if related:
+        code_context += f"Related code in other files (read-only):\n{related}\n"
+    
+    prompt = [
+        SystemMessage(content=fmt.instructions),
+        HumanMessage(content=(
+            (f"File: {path}\n" if path else "") +
+            f"Current Code:\n```python\n{window.text}\n```\n\n"
+            f"Step to Implement: {step}\n"
+            f"{code_context}"
+            f"External Context: {search_external(step)}\n\n"
+            f"{fmt.output_label}"
+        ))
+    ]
+    size = size_class(current_code)
+    # Steps on small files can go to a faster model (LLM_ROUTES developer_small=...)
+    role = "developer_small" if size == "small" else "developer"
+    
+    messages = prompt
+    for attempt in range(MAX_PATCH_ATTEMPTS):
+        with span("llm", node="developer"):
+            # Cached only once the edit applies and passes its checks, so failures aren't replayed
+            message = await llm.ainvoke(messages, role=role, defer_cache=True)
+        record_llm_usage(message, "developer")
+        response = message.content
+        logger.info(f"LLM response ({fmt.name}): {response[:200]}...")
+        
+        try:
+            with span("apply_edit", format=fmt.name):
+                diff, patch = fmt.apply(current_code, response, window)
+            failure = None if patch.applied else patch.describe_failures()
+        except (PatchError, EditFormatError) as e:
+            failure = str(e)
+        
+        if attempt == 0:
+            edit_history.record(fmt.name, size, failure is None)
+        
+        if failure is not None:
+            logger.warning(f"Edit for step '{step}' did not apply (attempt {attempt + 1}): {failure}")
+            # Feed the failure back so the retry can fix it
+            feedback = (
+                f"The edit could not be applied:\n{failure}\n\n"
+                "Regenerate it against the current code above, in the same format. Anything "
+                "quoted from the code must match the current code exactly."
+            )
+        else:
+            failure = await check_patch(current_code, patch, validate)
+            if failure is None:
+                await llm.confirm(messages, role=role)
+                return diff, patch
+            logger.warning(f"Edit for step '{step}' failed checks (attempt {attempt + 1}): {failure}")
+            feedback = (
+                f"{failure}\n\n"
+                "Regenerate the edit against the current code above so the step works "
+                "without breaking the code."
+            )
+        
+        messages = prompt + [AIMessage(content=response), HumanMessage(content=feedback)]
+    
+    raise PatchError(f"No usable edit after {MAX_PATCH_ATTEMPTS} attempts: {failure}")
+
+def speculative_dispatcher(code: str) -> Optional[Callable[[str], None]]:
+    """Planner callback that starts drafting streamed steps against the code being planned"""
+    if SPECULATIVE_STEPS <= 0:
+        return None
+    symbols = get_index(code).block_of()
+    claimed: Set[int] = set()
+    started = 0
+    
+    def on_step(step: str):
+        nonlocal started
+        if started >= SPECULATIVE_STEPS:
+            return
+        regions = step_regions(step, symbols)
+        # As in plan_batch: past the first step, stop at one that may overlap earlier ones,
+        # since its draft would likely have to be redone on top of them
+        if started and (regions is None or regions & claimed):
+            started = SPECULATIVE_STEPS
+            return
+        claimed.update(regions or ())
+        started += 1
+        speculation.dispatch(code, step, generate_step_patch(step, code))
+    
+    return on_step
+
+async def draft_step(step: str, current_code: str, plan_base: Optional[str],
+                     validate: Optional[Validator] = None) -> Tuple[str, PatchResult]:
+    """Diff for a step, reusing its speculative draft when there is one"""
+    draft = speculation.claim(plan_base, step) if plan_base is not None else None
+    if draft is None:
+        return await generate_step_patch(step, current_code, validate)
+    
+    try:
+        diff, patch = await draft
+    except Exception:
+        if plan_base == current_code:
+            raise  # Same inputs as a fresh attempt, which already ran out of retries
+        diff = None
+    
+    if diff is not None and plan_base == current_code:
+        SPECULATIVE_DRAFTS.inc(outcome="used")
+        return diff, patch
+    
+    if diff is not None:
+        # Earlier steps changed the code since the draft was made: rebase it
+        try:
+            with span("apply_patch"):
+                rebased = apply_patch(current_code, diff)
+        except PatchError:
+            rebased = None
+        if rebased is not None and rebased.applied and not rebased.replaced:
+            if await check_patch(current_code, rebased, validate) is None:
+                SPECULATIVE_DRAFTS.inc(outcome="rebased")
+                return diff, rebased
+    
+    logger.info(f"Speculative draft for step '{step}' is stale, regenerating")
+    SPECULATIVE_DRAFTS.inc(outcome="regenerated")
+    return await generate_step_patch(step, current_code, validate)
+
+async def run_steps(steps, current_code: str, validate: Optional[Validator] = None,
+                    plan_base: Optional[str] = None):
+    """Generate diffs for independent steps concurrently, then merge them in order"""
+    if len(steps) == 1:
+        diff, patch = await draft_step(steps[0], current_code, plan_base, validate)
+        with span("index_update"):
+            update_index(current_code, patch)
+        return [(diff, patch.code)]
+    
+    logger.info(f"Generating {len(steps)} independent steps concurrently")
+    drafts = await asyncio.gather(
+        *(draft_step(step, current_code, plan_base) for step in steps),
+        return_exceptions=True
+    )
+    
+    results = []
+    merged = current_code
+    for step, draft in zip(steps, drafts):
+        patch = None
+        if not isinstance(draft, BaseException):
+            diff = draft[0]
+            try:
+                with span("apply_patch"):
+                    patch = apply_patch(merged, diff)
+            except PatchError:
+                patch = None
+            # Merged results are held to the same checks as sequential steps
+            if patch is not None and patch.applied and await check_patch(merged, patch, None) is not None:
+                patch = None
+        
+        if patch is None or not patch.applied:
+            # Conflicts with an earlier step (or failed outright): redo it on the merged code
+            logger.info(f"Step '{step}' did not merge cleanly, regenerating sequentially")
+            diff, patch = await generate_step_patch(step, merged)
+        
+        with span("index_update"):
+            update_index(merged, patch)
+        merged = patch.code
+        results.append((diff, merged))
+    
+    return results
+
+def related_code(step: str, tree: Tree, target: str) -> str:
+    """Definitions a step names from files other than the one it changes, within a token budget"""
+    budget = WORKSPACE_RELATED_TOKENS * 4
+    parts = []
+    for path in rank_files(tree, step):
+        if path == target:
+            continue
+        for snippet in get_index(read(tree, path)).search(step):
+            if len(snippet) > budget:
+                continue
+            parts.append(f"From {path}:\n{snippet}")
+            budget -= len(snippet)
+        if budget <= 0:
+            break
+    return "\n\n".join(parts)
+
+async def workspace_step(state: AgentState) -> dict:
+    """Run the next steps of a multi-file plan; each one edits the single file it names"""
+    plan_steps = state.planner.plan_steps
+    idx = state.developer.current_idx
+    tree = state.workspace.tree()
+    
+    # Steps on different files are independent, so consecutive ones run together
+    batch = []
+    for step in plan_steps[idx:idx + MAX_PARALLEL_STEPS]:
+        path = step_target(step, tree)
+        if path is None and not batch:
+            raise ValueError(f"Step '{step}' does not name a file of the workspace")
+        if path is None or path in (target for _, target in batch):
+            break
+        batch.append((step, path))
+    
+    logger.info(f"Processing steps: {[f'{path}: {step}' for step, path in batch]}")
+    
+    async def edit(step: str, path: str) -> str:
+        with span("workspace_context"):
+            related = related_code(step, tree, path)
+        _, patch = await generate_step_patch(step, read(tree, path), path=path, related=related)
+        return patch.code
+    
+    results = await asyncio.gather(*(edit(step, path) for step, path in batch), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    
+    # Only the files the steps changed are stored; every other file keeps its blob
+    hashes = await asyncio.to_thread(get_blob_store().put_many, results)
+    next_idx = idx + len(batch)
+    logger.info(f"Applied {len(batch)} step(s) to {[path for _, path in batch]}, moving to step {next_idx + 1}")
+    
+    return {
+        'developer': state.developer.model_copy(update={
+            'plan_steps': plan_steps,
+            'current_idx': next_idx,
+            'diffs': state.developer.diffs + [
+                file_diff(path, read(tree, path), code) for (_, path), code in zip(batch, results)
+            ],
+            'developer_done': next_idx >= len(plan_steps)
+        }),
+        'workspace': WorkspaceChanges(changes=[{path: key} for (_, path), key in zip(batch, hashes)])
+    }
+
+async def developer_node(state: AgentState) -> dict:
     try:
         # Get plan steps from planner, not developer
-        plan_steps = state.planner.plan_steps if state.planner else []
-        idx = state.developer.current_idx if state.developer else 0
+        plan_steps = state.planner.plan_steps
+        idx = state.developer.current_idx
         
         logger.info(f"Developer processing step {idx + 1} of {len(plan_steps)}")
         
         # If no steps or index out of range, mark as done
         if not plan_steps or idx >= len(plan_steps):
             logger.info("Developer finished - no more steps to process")
-            return AgentState(
-                planner=state.planner,
-                developer=DeveloperState(
-                    plan_steps=plan_steps,
-                    current_idx=idx,
-                    code_after=state.developer.code_after if state.developer else "",
-                    developer_done=True
-                ),
-                code_history=state.code_history
-            )
-
-        step = plan_steps[idx]
-        current_code = state.code_history[-1] if state.code_history else ""
+            return {'developer': state.developer.model_copy(update={
+                'plan_steps': plan_steps,
+                'developer_done': True
+            })}
         
-        logger.info(f"Processing step: {step}")
-        
-        prompt = [
-            SystemMessage(content=(
-                "You are a Senior Developer. Analyze the current code and context, then generate a unified diff patch "
-                "that implements ONLY the requested step. Use the format:\n"
-                "```diff\n"
-                "--- original.py\n"
-                "+++ modified.py\n"
-                "@@ -x,y +a,b @@\n"
-                "- removed lines\n"
-                "+ added lines\n"
-                "```\n"
-                "Important: Only output the diff block, no explanations."
-            )),
-            HumanMessage(content=(
-                f"Current Code:\n```python\n{current_code}\n```\n\n"
-                f"Step to Implement: {step}\n"
-                f"Internal Context: {search_internal(step, current_code)}\n"
-                f"External Context: {search_external(step)}\n\n"
-                "Diff Output:"
-            ))
-        ]
-        
-        # Call LLM with timeout safety
-        response = llm.invoke(prompt).content
-        logger.info(f"LLM response: {response[:200]}...")
-        
-        diff = extract_diff(response)
+        if state.workspace:
+            return await workspace_step(state)
+
+        current_code = state.code_history[-1]
+        # Execution checks need each step's real result, so those steps run one at a time
+        checked = state.developer.run_code or bool(state.developer.tests)
+        max_parallel = 1 if checked else MAX_PARALLEL_STEPS
+        batch = plan_steps[idx:idx + plan_batch(plan_steps, idx, current_code, max_parallel)]
         
-        if not diff:
-            raise ValueError("No valid diff found in LLM response")
+        logger.info(f"Processing steps: {batch}")
         
-        new_code = apply_diff(current_code, diff)
-        new_code_history = state.code_history + [new_code] if state.code_history else [new_code]
+        validate = await make_validator(current_code, state.developer, final=idx + len(batch) >= len(plan_steps))
+        # The plan was made against the code as it was before any of its steps ran
+        plan_base = state.code_history[len(state.code_history) - 1 - idx] if idx < len(state.code_history) else None
+        try:
+            results = await run_steps(batch, current_code, validate, plan_base)
+        except BaseException:
+            # The step failed or the run was abandoned; either way nothing will claim the
+            # drafts of later steps, so stop their LLM calls now
+            if plan_base is not None:
+                speculation.discard(plan_base)
+            raise
+        new_diffs = [diff for diff, _ in results]
+        new_versions = [code for _, code in results]
+        next_idx = idx + len(results)
         
-        logger.info(f"Applied diff successfully, moving to step {idx + 2}")
+        logger.info(f"Applied {len(results)} diff(s) successfully, moving to step {next_idx + 1}")
         
-        return AgentState(
-            planner=state.planner,
-            developer=DeveloperState(
-                plan_steps=plan_steps,
-                current_idx=idx + 1,
-                code_after=new_code,
-                developer_done=(idx + 1 >= len(plan_steps))
-            ),
-            code_history=new_code_history
-        )
+        # model_copy skips re-validating the fields that didn't change; the new
+        # versions are appended to the history by its reducer (see history.merge_history)
+        return {
+            'developer': state.developer.model_copy(update={
+                'plan_steps': plan_steps,
+                'current_idx': next_idx,
+                'code_after': new_versions[-1],
+                'diffs': state.developer.diffs + new_diffs,
+                'developer_done': next_idx >= len(plan_steps)
+            }),
+            'code_history': NewVersions.after(current_code, new_versions)
+        }
     
     except Exception as e:
         logger.error(f"Developer error: {str(e)}")
-        
-        # Safely get developer attributes with defaults
-        dev_plan_steps = state.planner.plan_steps if state.planner else []
-        dev_current_idx = state.developer.current_idx if state.developer else 0
-        dev_code_after = state.developer.code_after if state.developer else ""
-        dev_done = state.developer.developer_done if state.developer else False
-        
-        return AgentState(
-            planner=state.planner,
-            developer=DeveloperState(
-                plan_steps=dev_plan_steps,
-                current_idx=dev_current_idx,
-                code_after=dev_code_after,
-                developer_done=dev_done,
-                error=f"Developer error at step {dev_current_idx+1}: {str(e)}"
-            ),
-            code_history=state.code_history
-        )
\ No newline at end of file
+        return {'developer': state.developer.model_copy(update={
+            'plan_steps': state.planner.plan_steps,
+            'error': f"Developer error at step {state.developer.current_idx + 1}: {str(e)}"
+        })}
@@ -0,0 +1,320 @@
+import os
+import re
+import textwrap
+import threading
+from typing import Dict, List, Tuple
+from patcher import apply_patch, PatchError, PatchResult, HunkResult, HUNK_HEADER
+from code_index import get_index
+from context import CodeWindow
+from scheduler import step_regions
+from tools import extract_diff
+from metrics import EDIT_FORMAT_ATTEMPTS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Unchanged lines around each change in the diffs recorded for non-diff formats
+DIFF_CONTEXT = 3
+
+# Files up to this many lines count as small when weighing formats
+SMALL_FILE_LINES = int(os.getenv("EDIT_SMALL_FILE_LINES", "200"))
+
+# Symbols longer than this are cheaper to edit with search/replace than to rewrite whole
+MAX_SYMBOL_LINES = int(os.getenv("EDIT_MAX_SYMBOL_LINES", "150"))
+
+# auto picks a format per step; anything else forces that format
+EDIT_FORMAT = os.getenv("EDIT_FORMAT", "auto").lower()
+
+class EditFormatError(ValueError):
+    """Raised when a response does not follow the requested edit format"""
+
+# (start, end, new_lines): replace lines[start:end] of the original code, 0-based
+Edit = Tuple[int, int, List[str]]
+
+def _trim(lines: List[str], edit: Edit) -> Edit:
+    """Narrow an edit to the lines it actually changes"""
+    start, end, replacement = edit
+    head = 0
+    while head < min(end - start, len(replacement)) and lines[start + head] == replacement[head]:
+        head += 1
+    tail = 0
+    while tail < min(end - start, len(replacement)) - head and lines[end - 1 - tail] == replacement[-1 - tail]:
+        tail += 1
+    return start + head, end - tail, replacement[head:len(replacement) - tail]
+
+def render_edits(code: str, edits: List[Edit]) -> Tuple[str, PatchResult]:
+    """Apply non-overlapping line edits, returning a unified diff of them and the result"""
+    lines = code.split('\n')
+    edits = sorted((_trim(lines, edit) for edit in edits), key=lambda edit: (edit[0], edit[1]))
+    # Edits that change nothing leave no hunk
+    edits = [edit for edit in edits if edit[0] != edit[1] or edit[2]]
+    if not edits:
+        raise EditFormatError("The edit leaves the code unchanged")
+    for (_, prev_end, _), (start, _, _) in zip(edits, edits[1:]):
+        if start < prev_end:
+            raise EditFormatError("Two edits change the same lines; merge them into one")
+
+    # Edits closer than twice the context share a hunk, as in diff -u
+    groups: List[List[Edit]] = []
+    for edit in edits:
+        if groups and edit[0] - groups[-1][-1][1] <= 2 * DIFF_CONTEXT:
+            groups[-1].append(edit)
+        else:
+            groups.append([edit])
+
+    diff = ["--- original.py", "+++ modified.py"]
+    hunks = []
+    new_code_lines = []
+    cursor = 0
+    drift = 0
+    for group in groups:
+        start = max(0, group[0][0] - DIFF_CONTEXT)
+        end = min(len(lines), group[-1][1] + DIFF_CONTEXT)
+        body = []
+        position = start
+        for edit_start, edit_end, replacement in group:
+            body.extend(f" {line}" for line in lines[position:edit_start])
+            body.extend(f"-{line}" for line in lines[edit_start:edit_end])
+            body.extend(f"+{line}" for line in replacement)
+            position = edit_end
+        body.extend(f" {line}" for line in lines[position:end])
+
+        old_len = end - start
+        new_len = old_len + sum(len(replacement) - (e - s) for s, e, replacement in group)
+        header = f"@@ -{start + 1},{old_len} +{start + 1 + drift},{new_len} @@"
+        diff.append(header)
+        diff.extend(body)
+        hunks.append(HunkResult(
+            index=len(hunks), header=header, applied=True, start=start, old_len=old_len, new_len=new_len
+        ))
+        drift += new_len - old_len
+
+        for edit_start, edit_end, replacement in group:
+            new_code_lines.extend(lines[cursor:edit_start])
+            new_code_lines.extend(replacement)
+            cursor = edit_end
+    new_code_lines.extend(lines[cursor:])
+
+    return "\n".join(diff), PatchResult(code='\n'.join(new_code_lines), hunks=hunks)
+
+def _find_block(lines: List[str], block: List[str]) -> List[int]:
+    """Positions where block occurs as whole lines, ignoring trailing whitespace"""
+    target = [line.rstrip() for line in block]
+    first = target[0]
+    return [
+        i for i in range(len(lines) - len(target) + 1)
+        if lines[i].rstrip() == first and [line.rstrip() for line in lines[i:i + len(target)]] == target
+    ]
+
+SEARCH_REPLACE_BLOCK = re.compile(
+    r'^<{5,9} SEARCH[ \t]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} REPLACE[ \t]*$',
+    re.MULTILINE | re.DOTALL
+)
+
+def parse_search_replace(response: str) -> List[Tuple[List[str], List[str]]]:
+    blocks = [
+        (search.rstrip('\n').split('\n'), replace.rstrip('\n').split('\n') if replace.strip('\n') else [])
+        for search, replace in SEARCH_REPLACE_BLOCK.findall(response)
+    ]
+    if len(blocks) != len(re.findall(r'^<{5,9} SEARCH', response, re.MULTILINE)):
+        raise EditFormatError("A SEARCH/REPLACE block is malformed: each needs SEARCH, ======= and REPLACE lines")
+    for search, _ in blocks:
+        if not any(line.strip() for line in search):
+            raise EditFormatError("A SEARCH section is empty; it must quote the lines being changed")
+    return blocks
+
+def search_replace_edits(code: str, blocks: List[Tuple[List[str], List[str]]]) -> List[Edit]:
+    lines = code.split('\n')
+    edits = []
+    for number, (search, replace) in enumerate(blocks, 1):
+        matches = _find_block(lines, search)
+        if not matches:
+            raise PatchError(f"Block {number}: SEARCH text not found; it must match the current code exactly:\n" + "\n".join(search[:5]))
+        if len(matches) > 1:
+            raise PatchError(f"Block {number}: SEARCH text occurs {len(matches)} times; include more surrounding lines")
+        edits.append((matches[0], matches[0] + len(search), replace))
+    return edits
+
+class EditFormat:
+    name = ""
+    instructions = ""  # System prompt describing the format
+    window_note = ""  # Extra guidance when only part of the file is shown
+    output_label = ""
+
+    def apply(self, code: str, response: str, window: CodeWindow) -> Tuple[str, PatchResult]:
+        """Parse a response strictly and apply it, returning a unified diff and the result"""
+        raise NotImplementedError
+
+class UnifiedDiffFormat(EditFormat):
+    name = "udiff"
+    instructions = (
+        "You are a Senior Developer. Analyze the current code and context, then generate a unified diff patch "
+        "that implements ONLY the requested step. Use the format:\n"
+        "```diff\n"
+        "--- original.py\n"
+        "+++ modified.py\n"
+        "@@ -x,y +a,b @@\n"
+        "- removed lines\n"
+        "+ added lines\n"
+        "```\n"
+        "Important: Only output the diff block, no explanations."
+    )
+    window_note = "Hunk line numbers refer to the code as shown."
+    output_label = "Diff Output:"
+
+    def apply(self, code, response, window):
+        diff = extract_diff(response)
+        # extract_diff falls back to the whole response; a whole file is not a diff
+        if not any(HUNK_HEADER.match(line) or line.startswith(('---', '+++')) for line in diff.split('\n')):
+            raise EditFormatError("No unified diff found; answer with a ```diff block with @@ hunk headers")
+        diff = window.reanchor(diff)
+        return diff, apply_patch(code, diff)
+
+class SearchReplaceFormat(EditFormat):
+    name = "search_replace"
+    instructions = (
+        "You are a Senior Developer. Analyze the current code and context, then edit the code to implement "
+        "ONLY the requested step. Write each change as a SEARCH/REPLACE block:\n"
+        "<<<<<<< SEARCH\n"
+        "exact lines from the current code\n"
+        "=======\n"
+        "the lines that replace them\n"
+        ">>>>>>> REPLACE\n"
+        "The SEARCH lines must match the current code exactly, including indentation, and must occur "
+        "only once; include a few surrounding lines if needed. Use as many blocks as needed, without "
+        "overlapping. Important: Only output the blocks, no explanations."
+    )
+    window_note = "SEARCH lines must be copied from the code shown."
+    output_label = "Edits:"
+
+    def apply(self, code, response, window):
+        blocks = parse_search_replace(response)
+        if not blocks:
+            raise EditFormatError("No SEARCH/REPLACE blocks found")
+        return render_edits(code, search_replace_edits(code, blocks))
+
+SYMBOL_DIRECTIVE = re.compile(
+    r'^### (REPLACE|INSERT AFTER) ([A-Za-z_][\w.]*)[ \t]*\n```(?:python)?[ \t]*\n(.*?)\n?^```[ \t]*$',
+    re.MULTILINE | re.DOTALL
+)
+
+class SymbolFormat(EditFormat):
+    name = "symbol"
+    instructions = (
+        "You are a Senior Developer. Analyze the current code and context, then implement ONLY the "
+        "requested step by rewriting whole functions, methods or classes. For each one you change, write:\n"
+        "### REPLACE qualified_name\n"
+        "```python\n"
+        "the complete new definition, including decorators\n"
+        "```\n"
+        "To add a new definition, write `### INSERT AFTER qualified_name` followed by the code block; "
+        "it is placed after that definition. Methods are named Class.method. For changes outside any "
+        "definition, such as imports, use a SEARCH/REPLACE block:\n"
+        "<<<<<<< SEARCH\n"
+        "exact lines from the current code\n"
+        "=======\n"
+        "the lines that replace them\n"
+        ">>>>>>> REPLACE\n"
+        "Important: Only output these sections, no explanations."
+    )
+    window_note = "Definitions are identified by name, so omitted code can still be referred to."
+    output_label = "Edits:"
+
+    def _symbol(self, index, qualname: str):
+        matches = [symbol for symbol in index.lookup(qualname.split('.')[-1]) if symbol.qualname == qualname]
+        if not matches:
+            raise PatchError(f"No function, method or class named '{qualname}'")
+        if len(matches) > 1:
+            raise PatchError(f"'{qualname}' is defined {len(matches)} times; use SEARCH/REPLACE instead")
+        return matches[0]
+
+    def apply(self, code, response, window):
+        directives = SYMBOL_DIRECTIVE.findall(response)
+        if len(directives) != len(re.findall(r'^### (REPLACE|INSERT AFTER)\b', response, re.MULTILINE)):
+            raise EditFormatError("A ### REPLACE or ### INSERT AFTER section is malformed: each needs a ```python block")
+        blocks = parse_search_replace(response)
+        if not directives and not blocks:
+            raise EditFormatError("No ### REPLACE, ### INSERT AFTER or SEARCH/REPLACE sections found")
+
+        index = get_index(code)
+        if directives and not index.valid:
+            raise PatchError("The current code does not parse, so definitions cannot be found by name")
+        lines = code.split('\n')
+        edits = search_replace_edits(code, blocks)
+        for action, qualname, source in directives:
+            symbol = self._symbol(index, qualname)
+            line = lines[symbol.start - 1]
+            indent = line[:len(line) - len(line.lstrip())]
+            new_lines = textwrap.indent(textwrap.dedent(source), indent).split('\n')
+            if action == 'REPLACE':
+                edits.append((symbol.start - 1, symbol.end, new_lines))
+            else:
+                # PEP 8 spacing: two blank lines between top-level definitions, one between methods
+                spacing = [''] * (1 if indent else 2)
+                edits.append((symbol.end, symbol.end, spacing + new_lines))
+        return render_edits(code, edits)
+
+FORMATS: Dict[str, EditFormat] = {
+    fmt.name: fmt for fmt in (UnifiedDiffFormat(), SearchReplaceFormat(), SymbolFormat())
+}
+
+class FormatHistory:
+    """First-try success rates per edit format and file size, seeded with priors"""
+    # Weight of the prior, in attempts
+    PRIOR_WEIGHT = 5
+
+    def __init__(self):
+        self._counts: Dict[Tuple[str, str], List[int]] = {}  # (format, size) -> [successes, attempts]
+        self._lock = threading.Lock()
+
+    def record(self, name: str, size: str, success: bool):
+        with self._lock:
+            counts = self._counts.setdefault((name, size), [0, 0])
+            counts[0] += success
+            counts[1] += 1
+        EDIT_FORMAT_ATTEMPTS.inc(format=name, size=size, outcome="success" if success else "failure")
+
+    def score(self, name: str, size: str, prior: float) -> float:
+        with self._lock:
+            successes, attempts = self._counts.get((name, size), (0, 0))
+        return (successes + prior * self.PRIOR_WEIGHT) / (attempts + self.PRIOR_WEIGHT)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {f"{name}/{size}": {'successes': s, 'attempts': a} for (name, size), (s, a) in self._counts.items()}
+
+history = FormatHistory()
+
+def size_class(code: str) -> str:
+    return "small" if code.count('\n') < SMALL_FILE_LINES else "large"
+
+def _targets_small_symbols(code: str, step: str) -> bool:
+    """Whether the step names definitions that are short enough to rewrite whole"""
+    index = get_index(code)
+    if not index.valid or step_regions(step, index.block_of()) is None:
+        return False
+    names = set(re.findall(r'[A-Za-z_]\w*', step))
+    symbols = [
+        symbol for name in names for symbol in index.lookup(name)
+        if symbol.name == name and symbol.kind in ('function', 'method', 'class')
+    ]
+    return bool(symbols) and all(symbol.end - symbol.start < MAX_SYMBOL_LINES for symbol in symbols)
+
+def choose_format(code: str, step: str) -> EditFormat:
+    """Edit format for a step, from the file size, the step's targets and past success"""
+    if not code.strip():
+        # A new or empty file has nothing to search for or rewrite; a diff can only add lines
+        return FORMATS['udiff']
+    if EDIT_FORMAT in FORMATS:
+        return FORMATS[EDIT_FORMAT]
+
+    size = size_class(code)
+    # Priors: line-numbered diffs are fine on short files but drift on long ones; search/replace
+    # is anchored by content; whole-symbol rewrites suit steps aimed at short definitions
+    priors = {
+        'udiff': 0.75 if size == "small" else 0.5,
+        'search_replace': 0.8
+    }
+    if _targets_small_symbols(code, step):
+        priors['symbol'] = 0.85
+    return FORMATS[max(priors, key=lambda name: history.score(name, size, priors[name]))]
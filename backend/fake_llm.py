@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from typing import Optional
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
+from llm_cache import SQLiteCache, cache_key
+import logging
+
+logger = logging.getLogger(__name__)
+
+CODE_BLOCK = re.compile(r"Current Code:\n```python\n(.*?)\n```", re.DOTALL)
+STEP_LINE = re.compile(r"^Step to Implement: (.*)$", re.MULTILINE)
+FUNCTION_DEF = re.compile(r"^def ([A-Za-z_]\w*)\(", re.MULTILINE)
+STEP_TARGET = re.compile(r"`([A-Za-z_]\w*)`")
+WORKSPACE_FILE = re.compile(r"^File (\S+):\n```python\n(.*?)\n```", re.MULTILINE | re.DOTALL)
+
+class FakeLLM:
+    """Offline stand-in for the chat model with deterministic planner and diff responses
+
+    Responses come from a recording when one matches the prompt, otherwise they are
+    synthesized: the plan documents a spread of top-level functions, one step each, and
+    every step's edit adds a docstring to its function, in whichever edit format was asked for.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, plan_steps: int = 3,
+                 recording: Optional[SQLiteCache] = None, params: Optional[dict] = None,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.plan_steps = plan_steps
+        self.recording = recording
+        self.params = params or {}
+        self.calls = 0
+        self.replayed = 0
+        self._random = random.Random(seed)
+
+    def _delay(self) -> float:
+        if not self.jitter:
+            return self.latency
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _respond(self, messages) -> AIMessage:
+        self.calls += 1
+        content = None
+        if self.recording is not None:
+            content = self.recording.get(cache_key(messages, self.params))
+            if content is not None:
+                self.replayed += 1
+        if content is None:
+            if len(messages) < 2:
+                # Not an agent prompt, e.g. a start-up pre-warm call
+                content = "OK"
+            elif "Software Architect" in messages[0].content:
+                content = self._plan(messages[1].content)
+            else:
+                # Retries append feedback; the original request is always the second message
+                content = self._edit(messages[0].content, messages[1].content)
+
+        prompt_chars = sum(len(message.content) for message in messages)
+        return AIMessage(content=content, usage_metadata={
+            'input_tokens': prompt_chars // 4,
+            'output_tokens': len(content) // 4,
+            'total_tokens': (prompt_chars + len(content)) // 4
+        })
+
+    def _plan(self, prompt: str) -> str:
+        if "Project files:" in prompt:
+            return self._plan_workspace(prompt)
+        match = CODE_BLOCK.search(prompt)
+        names = FUNCTION_DEF.findall(match.group(1)) if match else []
+        if not names:
+            return "1. Add a module docstring describing the code\n"
+
+        count = min(self.plan_steps, len(names))
+        # Spread the targets over the file so large inputs exercise windowing
+        stride = len(names) / count
+        targets = [names[int(i * stride)] for i in range(count)]
+        return "".join(f"{i + 1}. Add a docstring to function `{name}`\n" for i, name in enumerate(targets))
+
+    def _plan_workspace(self, prompt: str) -> str:
+        """A docstring step for the first function of each file shown in full"""
+        targets = [
+            (path, name)
+            for path, code in WORKSPACE_FILE.findall(prompt)
+            for name in FUNCTION_DEF.findall(code)[:1]
+        ][:self.plan_steps]
+        if not targets:
+            return "1. Add a module docstring describing the code\n"
+        return "".join(f"{i + 1}. {path}: Add a docstring to function `{name}`\n" for i, (path, name) in enumerate(targets))
+
+    def _edit(self, instructions: str, prompt: str) -> str:
+        """Docstring edit for the step, in the format the system prompt asks for"""
+        code_match = CODE_BLOCK.search(prompt)
+        step_match = STEP_LINE.search(prompt)
+        lines = code_match.group(1).split('\n') if code_match else []
+        step = step_match.group(1) if step_match else ""
+        target = STEP_TARGET.search(step)
+        if not lines:
+            return ""
+        fmt = "symbol" if "### REPLACE" in instructions else "search_replace" if "<<<<<<< SEARCH" in instructions else "udiff"
+
+        # Line numbers are taken from the code as shown, like a real model would
+        start = None
+        if target:
+            prefix = f"def {target.group(1)}("
+            start = next((i for i, line in enumerate(lines) if line.lstrip().startswith(prefix)), None)
+        if start is None:
+            docstring = '"""' + (step or 'Module') + '."""'
+            if fmt == "udiff":
+                return (
+                    "```diff\n--- original.py\n+++ modified.py\n"
+                    f"@@ -1,1 +1,2 @@\n+{docstring}\n {lines[0]}\n```"
+                )
+            return f"<<<<<<< SEARCH\n{lines[0]}\n=======\n{docstring}\n{lines[0]}\n>>>>>>> REPLACE"
+
+        end = start
+        while end < len(lines) - 1 and not lines[end].rstrip().endswith(':'):
+            end += 1
+        def_indent = lines[start][:len(lines[start]) - len(lines[start].lstrip())]
+        signature = lines[start:end + 1]
+        docstring = f'{def_indent}    """{target.group(1)} (documented)."""'
+
+        if fmt == "search_replace":
+            return "<<<<<<< SEARCH\n" + "\n".join(signature) + "\n=======\n" + "\n".join(signature + [docstring]) + "\n>>>>>>> REPLACE"
+        if fmt == "symbol":
+            body_end = end + 1
+            while body_end < len(lines) and (not lines[body_end].strip() or len(lines[body_end]) - len(lines[body_end].lstrip()) > len(def_indent)):
+                body_end += 1
+            while body_end > end + 1 and not lines[body_end - 1].strip():
+                body_end -= 1
+            source = signature + [docstring] + lines[end + 1:body_end]
+            return f"### REPLACE {target.group(1)}\n```python\n" + "\n".join(source) + "\n```"
+
+        hunk = [f" {line}" for line in signature] + [f"+{docstring}"]
+        return (
+            "```diff\n--- original.py\n+++ modified.py\n"
+            f"@@ -{start + 1},{len(signature)} +{start + 1},{len(signature) + 1} @@\n"
+            + "\n".join(hunk) + "\n```"
+        )
+
+    def invoke(self, messages, **kwargs):
+        time.sleep(self._delay())
+        return self._respond(messages)
+
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(self._delay())
+        return self._respond(messages)
+
+    async def astream(self, messages, **kwargs):
+        # Line by line, with the latency spread over the response like a real stream
+        message = self._respond(messages)
+        lines = message.content.splitlines(keepends=True) or [""]
+        delay = self._delay() / len(lines)
+        for i, line in enumerate(lines):
+            await asyncio.sleep(delay)
+            last = i == len(lines) - 1
+            yield AIMessageChunk(content=line, usage_metadata=message.usage_metadata if last else None)
+
+def fake_from_env(params: Optional[dict] = None) -> FakeLLM:
+    """FakeLLM configured by the FAKE_LLM_* environment variables"""
+    path = os.getenv("FAKE_LLM_RECORDING")
+    # An LLM_CACHE=sqlite database from a real run doubles as a recording
+    recording = SQLiteCache(path, ttl=None) if path else None
+    logger.info(f"Using fake LLM (recording: {path or 'none'})")
+    return FakeLLM(
+        latency=float(os.getenv("FAKE_LLM_LATENCY", "0")),
+        jitter=float(os.getenv("FAKE_LLM_JITTER", "0")),
+        plan_steps=int(os.getenv("FAKE_LLM_PLAN_STEPS", "3")),
+        recording=recording,
+        params=params
+    )
+
+MESSAGE_TYPES = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+
+def openai_app(fake: FakeLLM, rate_limit: float = 0.0, burst: int = 1):
+    """OpenAI-compatible chat completions server backed by a FakeLLM
+
+    Lets provider=openai clients in LLM_CLIENTS be exercised offline. With rate_limit
+    set, requests beyond that many per second get a 429 with Retry-After, like a quota.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from limits import RateLimiter
+
+    app = FastAPI()
+    quota = RateLimiter(rate_limit, burst)
+
+    def usage_of(message: AIMessage) -> dict:
+        usage = message.usage_metadata or {}
+        return {
+            'prompt_tokens': usage.get('input_tokens', 0),
+            'completion_tokens': usage.get('output_tokens', 0),
+            'total_tokens': usage.get('total_tokens', 0)
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        wait = quota.try_acquire()
+        if wait:
+            return JSONResponse(status_code=429, headers={'retry-after': f"{wait:.3f}"}, content={
+                'error': {'message': "Rate limit exceeded", 'type': 'rate_limit_error', 'code': 'rate_limit_exceeded'}
+            })
+
+        messages = [MESSAGE_TYPES.get(message['role'], HumanMessage)(content=message['content']) for message in body['messages']]
+        base = {'id': f"fake-{fake.calls}", 'created': int(time.time()), 'model': body.get('model', 'fake')}
+        if not body.get('stream'):
+            message = await fake.ainvoke(messages)
+            return {**base, 'object': 'chat.completion', 'usage': usage_of(message), 'choices': [
+                {'index': 0, 'message': {'role': 'assistant', 'content': message.content}, 'finish_reason': 'stop'}
+            ]}
+
+        async def events():
+            usage = None
+            async for chunk in fake.astream(messages):
+                usage = chunk.usage_metadata or usage
+                yield "data: " + json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [
+                    {'index': 0, 'delta': {'role': 'assistant', 'content': chunk.content}, 'finish_reason': None}
+                ]}) + "\n\n"
+            yield "data: " + json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [
+                {'index': 0, 'delta': {}, 'finish_reason': 'stop'}
+            ]}) + "\n\n"
+            if (body.get('stream_options') or {}).get('include_usage'):
+                yield "data: " + json.dumps({
+                    **base, 'object': 'chat.completion.chunk', 'choices': [],
+                    'usage': usage_of(AIMessage(content="", usage_metadata=usage))
+                }) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+if __name__ == '__main__':
+    # Local OpenAI-compatible stand-in: python fake_llm.py --port 8001 --rate-limit 5
+    parser = argparse.ArgumentParser(description="Serve the fake LLM over the OpenAI chat completions API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="requests per second before answering 429")
+    parser.add_argument('--burst', type=int, default=1, help="requests allowed at once within the rate limit")
+    args = parser.parse_args()
+
+    import uvicorn
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(openai_app(fake_from_env(), args.rate_limit, args.burst), host=args.host, port=args.port)
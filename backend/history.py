@@ -0,0 +1,130 @@
+import difflib
+from typing import List, Tuple, Union
+from pydantic import BaseModel, model_validator
+
+class Delta(BaseModel):
+    """Line edits that turn one version of the code into its predecessor"""
+    ops: List[Tuple[int, int, List[str]]] = []  # (start, end, replacement) over the newer version's lines
+
+    @classmethod
+    def between(cls, newer: List[str], older: List[str]) -> "Delta":
+        # Trim the common prefix and suffix first; patches are usually local
+        prefix = 0
+        limit = min(len(newer), len(older))
+        while prefix < limit and newer[prefix] == older[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and newer[-1 - suffix] == older[-1 - suffix]:
+            suffix += 1
+
+        a = newer[prefix:len(newer) - suffix]
+        b = older[prefix:len(older) - suffix]
+        ops = [
+            (prefix + i1, prefix + i2, b[j1:j2])
+            for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes()
+            if tag != 'equal'
+        ]
+        return cls.model_construct(ops=ops)
+
+    def apply(self, lines: List[str]) -> List[str]:
+        result = []
+        cursor = 0
+        for start, end, replacement in self.ops:
+            result.extend(lines[cursor:start])
+            result.extend(replacement)
+            cursor = end
+        result.extend(lines[cursor:])
+        return result
+
+    @property
+    def size(self) -> int:
+        return sum(len(line) + 1 for _, _, replacement in self.ops for line in replacement)
+
+class CodeHistory(BaseModel):
+    """Every version of the code, stored as the latest snapshot plus reverse deltas"""
+    head: str = ""
+    reverse_deltas: List[Delta] = []  # reverse_deltas[k] turns version k + 1 into version k
+
+    @model_validator(mode='before')
+    @classmethod
+    def from_versions(cls, value):
+        # Accept the plain list of versions used by callers and older clients
+        if isinstance(value, (list, tuple)):
+            if not value:
+                return {'head': ''}
+            history = cls.model_construct(head=value[0], reverse_deltas=[]).extended(list(value[1:]))
+            return {'head': history.head, 'reverse_deltas': history.reverse_deltas}
+        return value
+
+    def __len__(self) -> int:
+        return len(self.reverse_deltas) + 1
+
+    def __getitem__(self, version: int) -> str:
+        count = len(self)
+        if version < 0:
+            version += count
+        if not 0 <= version < count:
+            raise IndexError(f"Version {version} out of range (history has {count})")
+        if version == count - 1:
+            return self.head
+
+        # Walk back from the head; recent versions are the cheap ones
+        lines = self.head.split('\n')
+        for delta in reversed(self.reverse_deltas[version:]):
+            lines = delta.apply(lines)
+        return '\n'.join(lines)
+
+    def versions(self) -> List[str]:
+        """All versions, oldest first, reconstructed in a single backward pass"""
+        lines = self.head.split('\n')
+        result = [self.head]
+        for delta in reversed(self.reverse_deltas):
+            lines = delta.apply(lines)
+            result.append('\n'.join(lines))
+        return result[::-1]
+
+    def appended(self, code: str) -> "CodeHistory":
+        """New history with code as the head; existing deltas are shared, not copied"""
+        delta = Delta.between(code.split('\n'), self.head.split('\n'))
+        return CodeHistory.model_construct(head=code, reverse_deltas=self.reverse_deltas + [delta])
+
+    def extended(self, versions: List[str]) -> "CodeHistory":
+        history = self
+        for code in versions:
+            history = history.appended(code)
+        return history
+
+    def truncated(self, count: int) -> "CodeHistory":
+        """History holding only the first count versions"""
+        if not 1 <= count <= len(self):
+            raise IndexError(f"Cannot keep {count} of {len(self)} versions")
+        return CodeHistory.model_construct(head=self[count - 1], reverse_deltas=self.reverse_deltas[:count - 1])
+
+    def summary(self) -> str:
+        delta_chars = sum(delta.size for delta in self.reverse_deltas)
+        return f"<{len(self)} versions, head {len(self.head)} chars, deltas {delta_chars} chars>"
+
+class NewVersions(BaseModel):
+    """Versions to append to the code_history channel (see merge_history)
+
+    Stored like a history of its own, the newest version plus reverse deltas back to the
+    code it was made from, so the update (which is checkpointed) holds one full copy of
+    the code however many versions it adds.
+    """
+    head: str
+    reverse_deltas: List[Delta] = []
+
+    @classmethod
+    def after(cls, base: str, versions: List[str]) -> "NewVersions":
+        """The versions made, in order, on top of base (the history's current head)"""
+        tail = CodeHistory.model_construct(head=base, reverse_deltas=[]).extended(versions)
+        return cls.model_construct(head=tail.head, reverse_deltas=tail.reverse_deltas)
+
+def merge_history(history: CodeHistory, update: Union[NewVersions, CodeHistory, List[str]]) -> CodeHistory:
+    """Reducer for the code_history channel: NewVersions are appended, anything else replaces it"""
+    # Appending only adds the update's deltas, however long the history already is
+    if isinstance(update, NewVersions):
+        history = CodeHistory.model_validate(history)
+        return CodeHistory.model_construct(head=update.head, reverse_deltas=history.reverse_deltas + update.reverse_deltas)
+    # Graph input and rollbacks set the whole history
+    return CodeHistory.model_validate(update)
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from metrics import REQUESTS_SHARED, RUNS_CANCELLED
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ClientDisconnected(Exception):
+    """Raised to a request whose client went away before its run finished"""
+
+class IdempotencyError(Exception):
+    """Raised when an idempotency key is reused for a different request"""
+
+def request_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+class _Run:
+    """An agent run that any number of identical requests wait on"""
+
+    def __init__(self, fingerprint: str, task: asyncio.Task):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.waiters = 0
+
+class InFlightRequests:
+    """Identical agent requests share one run, which is cancelled once all their clients are gone
+
+    A run is keyed by the client's idempotency key if it sent one, otherwise by a
+    hash of the request. Successful results of idempotent requests are kept for
+    `ttl` seconds, so a retry after a dropped connection gets the same answer.
+    """
+
+    def __init__(self, ttl: float = 600.0, max_results: int = 1024):
+        self.ttl = ttl
+        self.max_results = max_results
+        self._runs: Dict[str, _Run] = {}
+        self._results: "OrderedDict[str, Tuple[float, str, dict]]" = OrderedDict()  # key -> (expiry, fingerprint, result)
+        self.coalesced = 0
+        self.replayed = 0
+        self.cancelled = 0
+
+    def _stored(self, key: str, fingerprint: str) -> Optional[dict]:
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        expires, stored_fingerprint, result = entry
+        if expires < time.monotonic():
+            del self._results[key]
+            return None
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyError("Idempotency-Key was already used for a different request")
+        return result
+
+    def _finish(self, key: str, run: _Run, remember: bool):
+        if self._runs.get(key) is run:
+            del self._runs[key]
+        if not remember or self.ttl <= 0 or run.task.cancelled() or run.task.exception() is not None:
+            return
+        self._results[key] = (time.monotonic() + self.ttl, run.fingerprint, run.task.result())
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    async def run(self, key: str, fingerprint: str, start: Callable[[], Awaitable[dict]],
+                  disconnected: Callable[[], Awaitable], remember: bool = False) -> dict:
+        """Result of the run for key, started with start() unless one is already in flight
+
+        Raises ClientDisconnected once disconnected() returns; the run itself is only
+        cancelled when no other request is waiting for it.
+        """
+        if remember:
+            stored = self._stored(key, fingerprint)
+            if stored is not None:
+                self.replayed += 1
+                REQUESTS_SHARED.inc(outcome="replayed")
+                logger.info(f"Replaying stored result for request {key[:12]}")
+                return dict(stored)
+
+        run = self._runs.get(key)
+        if run is not None:
+            if run.fingerprint != fingerprint:
+                raise IdempotencyError("Idempotency-Key is in use by a different request")
+            self.coalesced += 1
+            REQUESTS_SHARED.inc(outcome="coalesced")
+            logger.info(f"Joining in-flight run for request {key[:12]}")
+        else:
+            run = _Run(fingerprint, asyncio.ensure_future(start()))
+            self._runs[key] = run
+            run.task.add_done_callback(lambda _: self._finish(key, run, remember))
+        return await self._wait(key, run, disconnected)
+
+    async def _wait(self, key: str, run: _Run, disconnected: Callable[[], Awaitable]) -> dict:
+        run.waiters += 1
+        watcher = asyncio.ensure_future(disconnected())
+        try:
+            done, _ = await asyncio.wait({run.task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if run.task not in done:
+                raise ClientDisconnected("Client disconnected")
+            # Every waiter gets its own copy of the shared result
+            return dict(run.task.result())
+        finally:
+            watcher.cancel()
+            run.waiters -= 1
+            if not run.waiters and not run.task.done():
+                # Nobody is left to use the result; later identical requests start afresh
+                if self._runs.get(key) is run:
+                    del self._runs[key]
+                run.task.cancel()
+                self.cancelled += 1
+                RUNS_CANCELLED.inc()
+                logger.info(f"Cancelled run for request {key[:12]}: every client disconnected")
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._runs),
+            'stored_results': len(self._results),
+            'coalesced': self.coalesced,
+            'replayed': self.replayed,
+            'cancelled': self.cancelled
+        }
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from metrics import span
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CapacityError(Exception):
+    """Raised when a request cannot get a slot within the queue limits"""
+
+class ConcurrencyLimiter:
+    """Bounded concurrency with a bounded, time-limited wait queue"""
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.queued = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one execution slot for the duration of the block"""
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            raise CapacityError(f"Agent queue full ({self.queued} waiting)")
+
+        self.queued += 1
+        try:
+            with span("queue_wait"):
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise CapacityError(f"Timed out after {self.queue_timeout}s waiting for an agent slot")
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per second with bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """Take tokens if they are available and return 0, else the seconds until they will be"""
+        if self.rate <= 0:
+            return 0.0  # Unlimited
+        # A request larger than the bucket waits for a full bucket rather than forever
+        amount = min(amount, self.burst)
+        self._refill()
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    async def acquire(self, amount: float = 1):
+        while True:
+            wait = self.try_acquire(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def drain(self):
+        """Drop any saved-up burst, so what follows is paced at the current rate"""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+    def charge(self, amount: float):
+        """Take tokens without waiting (e.g. usage only known afterwards); later acquires pay it back"""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self._tokens -= amount
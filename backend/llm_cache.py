@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from metrics import LLM_CACHE_LOOKUPS
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CacheBackend:
+    """Key/value store for LLM responses with LRU and TTL eviction"""
+    # Backends that touch the disk are queried from a worker thread in async code
+    blocking = False
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+class MemoryCache(CacheBackend):
+    """In-process LRU cache"""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteCache(CacheBackend):
+    """On-disk LRU cache shared by every worker on the host"""
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: Optional[float] = 86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "stored_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_used_at ON llm_cache (used_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, stored_at = row
+            if self.ttl is not None and now - stored_at > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE llm_cache SET used_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # Evict least recently used entries beyond the size limit
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+def cache_key(messages, params: dict) -> str:
+    """Content-addressed key for a rendered prompt and model parameters"""
+    payload = {
+        'params': params,
+        'messages': [[message.type, message.content] for message in messages]
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+# Deferred responses held until confirm() says they turned out usable
+MAX_UNCONFIRMED = 256
+
+class CachedLLM:
+    """Wraps a chat model so identical prompts replay the stored response
+
+    Callers that can only judge a response later (e.g. whether an edit applies)
+    pass defer_cache=True and call confirm() once it proved usable, so a bad
+    answer is never replayed.
+    """
+
+    def __init__(self, llm, backend: CacheBackend, params: dict):
+        self.llm = llm
+        self.backend = backend
+        self.params = params
+        self.hits = 0
+        self.misses = 0
+        self._unconfirmed: "OrderedDict[str, str]" = OrderedDict()
+
+    def invoke(self, messages, **kwargs):
+        key = cache_key(messages, self.params)
+        cached = self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            LLM_CACHE_LOOKUPS.inc(result="hit")
+            logger.info(f"LLM cache hit {key[:12]}")
+            from langchain_core.messages import AIMessage
+            return AIMessage(content=cached)
+
+        self.misses += 1
+        LLM_CACHE_LOOKUPS.inc(result="miss")
+        response = self.llm.invoke(messages, **kwargs)
+        if response.content:
+            self.backend.set(key, response.content)
+        return response
+
+    async def _aget(self, key: str) -> Optional[str]:
+        if self.backend.blocking:
+            cached = await asyncio.to_thread(self.backend.get, key)
+        else:
+            cached = self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            LLM_CACHE_LOOKUPS.inc(result="hit")
+            logger.info(f"LLM cache hit {key[:12]}")
+        else:
+            self.misses += 1
+            LLM_CACHE_LOOKUPS.inc(result="miss")
+        return cached
+
+    async def _aset(self, key: str, value: str):
+        if self.backend.blocking:
+            await asyncio.to_thread(self.backend.set, key, value)
+        else:
+            self.backend.set(key, value)
+
+    async def ainvoke(self, messages, defer_cache: bool = False, **kwargs):
+        key = cache_key(messages, self.params)
+        cached = await self._aget(key)
+        if cached is not None:
+            from langchain_core.messages import AIMessage
+            return AIMessage(content=cached)
+
+        response = await self.llm.ainvoke(messages, **kwargs)
+        if response.content:
+            await self._store(key, response.content, defer_cache)
+        return response
+
+    async def _store(self, key: str, content: str, defer_cache: bool):
+        if defer_cache:
+            self._unconfirmed[key] = content
+            while len(self._unconfirmed) > MAX_UNCONFIRMED:
+                self._unconfirmed.popitem(last=False)
+        else:
+            await self._aset(key, content)
+
+    async def confirm(self, messages):
+        """Cache the deferred response to these messages, if this model gave one"""
+        key = cache_key(messages, self.params)
+        content = self._unconfirmed.pop(key, None)
+        if content is not None:
+            await self._aset(key, content)
+
+    async def astream(self, messages, defer_cache: bool = False, **kwargs):
+        key = cache_key(messages, self.params)
+        cached = await self._aget(key)
+        if cached is not None:
+            from langchain_core.messages import AIMessageChunk
+            yield AIMessageChunk(content=cached)
+            return
+
+        # Pass chunks through as they arrive and store the assembled response at the end
+        parts = []
+        async for chunk in self.llm.astream(messages, **kwargs):
+            if isinstance(chunk.content, str):
+                parts.append(chunk.content)
+            yield chunk
+        content = "".join(parts)
+        if content:
+            await self._store(key, content, defer_cache)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.backend)
+        }
+
+    def __getattr__(self, name):
+        # Anything we don't wrap goes straight to the underlying model
+        return getattr(self.llm, name)
+
+def cache_from_env() -> Optional[CacheBackend]:
+    """Build the cache backend selected by LLM_CACHE (memory, sqlite or off)"""
+    kind = os.getenv("LLM_CACHE", "memory").lower()
+    ttl = float(os.getenv("LLM_CACHE_TTL", "3600")) or None
+    if kind == "memory":
+        return MemoryCache(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+            ttl=ttl
+        )
+    if kind == "sqlite":
+        return SQLiteCache(
+            path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+            ttl=ttl
+        )
+    if kind not in ("off", "none", ""):
+        logger.warning(f"Unknown LLM_CACHE backend '{kind}', caching disabled")
+    return None
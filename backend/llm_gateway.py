@@ -0,0 +1,477 @@
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from limits import RateLimiter
+from llm_cache import CacheBackend, CachedLLM, cache_key
+from metrics import span, LLM_CALLS, LLM_COALESCED, LLM_HEDGES
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying; 429 also slows the client down
+RATE_LIMITED = 429
+TRANSIENT = (RATE_LIMITED, 500, 502, 503, 504)
+STATUS_IN_MESSAGE = re.compile(r'\b(429|500|502|503|504)\b|RESOURCE_EXHAUSTED|UNAVAILABLE')
+
+def error_status(error: Exception) -> Optional[int]:
+    """HTTP status behind a provider error, if it can be told"""
+    for source in (error, getattr(error, 'response', None)):
+        for attr in ('status_code', 'code', 'status'):
+            value = getattr(source, attr, None)
+            if isinstance(value, int):
+                return value
+    # LangChain wrappers often keep only the provider's message
+    match = STATUS_IN_MESSAGE.search(str(error))
+    if not match:
+        return None
+    if match.group(1):
+        return int(match.group(1))
+    return RATE_LIMITED if match.group(0) == 'RESOURCE_EXHAUSTED' else 503
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(messages) -> int:
+    # ~4 characters per token, as in context.py
+    return sum(len(message.content) for message in messages) // 4
+
+class ModelClient:
+    """One configured chat model with its own quotas, concurrency cap and backoff
+
+    Requests per minute and tokens per minute are token buckets. A 429 pauses the
+    client for the backoff delay and halves its request rate, which then recovers
+    by 5% of the configured rate per successful call. The chat model can be given
+    as a `factory` instead, which is called on first use.
+    """
+
+    def __init__(self, name: str, model, params: dict, rpm: float = 0, tpm: float = 0,
+                 burst: Optional[int] = None, max_concurrency: int = 0, max_retries: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 factory: Optional[Callable[[], Any]] = None):
+        self.name = name
+        self._model = model
+        self._factory = factory
+        self._build_lock = threading.Lock()
+        self.params = params
+        self.rpm = rpm
+        # Bursts default to ten seconds' worth of requests
+        self.requests = RateLimiter(rpm / 60, burst or max(1, int(rpm / 6)))
+        self.tokens = RateLimiter(tpm / 60, int(tpm) or 1)
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._scale = 1.0
+        self._paused_until = 0.0
+        self.calls = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.cached = self  # Replaced by a CachedLLM around this client when caching is on
+
+    @property
+    def model(self):
+        # Provider SDKs are slow to import, so models are built at start-up or on first use
+        if self._model is None:
+            with self._build_lock:
+                if self._model is None:
+                    self._model = self._factory()
+        return self._model
+
+    async def _built(self):
+        # Built in a thread so the event loop keeps serving while the SDK loads
+        if self._model is None:
+            await asyncio.to_thread(lambda: self.model)
+        return self._model
+
+    async def start(self, prewarm: bool = False):
+        """Build the model; `prewarm` also opens its connection with a tiny call"""
+        model = await self._built()
+        if not prewarm:
+            return
+        from langchain_core.messages import HumanMessage
+        try:
+            with span("llm_client", client=self.name):
+                await model.ainvoke([HumanMessage(content="Reply with OK.")])
+        except Exception as e:
+            # The first real request will try again; a cold client is no reason to stay unready
+            logger.warning(f"LLM client '{self.name}' failed to pre-warm: {e}")
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            # Exponential with jitter, so clients that were throttled together don't retry together
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        return delay
+
+    def _throttle(self, delay: float):
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        if self.rpm > 0:
+            self._scale = max(0.1, self._scale / 2)
+            self.requests.rate = self.rpm / 60 * self._scale
+            self.requests.drain()
+            logger.warning(f"LLM client '{self.name}' rate limited; now at {self.requests.rate * 60:.0f} requests/min")
+
+    def _recover(self):
+        if self._scale < 1.0:
+            self._scale = min(1.0, self._scale + 0.05)
+            self.requests.rate = self.rpm / 60 * self._scale
+
+    async def _admit(self, messages):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.requests.acquire()
+        await self.tokens.acquire(estimate_tokens(messages))
+
+    def _settle(self, usage: Optional[dict]):
+        # Completion tokens are only known afterwards; later requests wait for them
+        self.tokens.charge((usage or {}).get('output_tokens', 0))
+        self._recover()
+
+    async def _retry_or_raise(self, error: Exception, attempt: int):
+        status = error_status(error)
+        if status not in TRANSIENT or attempt >= self.max_retries:
+            LLM_CALLS.inc(client=self.name, outcome="error")
+            raise error
+        delay = self._backoff(error, attempt)
+        if status == RATE_LIMITED:
+            LLM_CALLS.inc(client=self.name, outcome="rate_limited")
+            self._throttle(delay)
+        else:
+            LLM_CALLS.inc(client=self.name, outcome="transient")
+        self.retries += 1
+        logger.warning(f"LLM client '{self.name}' got {status}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def ainvoke(self, messages, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            async with self._slots or nullcontext():
+                await self._admit(messages)
+                self.calls += 1
+                try:
+                    model = await self._built()
+                    with span("llm_client", client=self.name):
+                        response = await model.ainvoke(messages, **kwargs)
+                except Exception as e:
+                    error = e
+                else:
+                    LLM_CALLS.inc(client=self.name, outcome="ok")
+                    self._settle(getattr(response, 'usage_metadata', None))
+                    return response
+            await self._retry_or_raise(error, attempt)
+
+    async def astream(self, messages, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            started = False
+            async with self._slots or nullcontext():
+                await self._admit(messages)
+                self.calls += 1
+                try:
+                    usage = None
+                    model = await self._built()
+                    async for chunk in model.astream(messages, **kwargs):
+                        started = True
+                        usage = getattr(chunk, 'usage_metadata', None) or usage
+                        yield chunk
+                except Exception as e:
+                    # Part of the response is already out; it can't be taken back
+                    if started:
+                        LLM_CALLS.inc(client=self.name, outcome="error")
+                        raise
+                    error = e
+                else:
+                    LLM_CALLS.inc(client=self.name, outcome="ok")
+                    self._settle(usage)
+                    return
+            await self._retry_or_raise(error, attempt)
+
+    def stats(self) -> dict:
+        cache = self.cached.stats() if isinstance(self.cached, CachedLLM) else None
+        return {
+            'model': self.params.get('model'),
+            'calls': self.calls,
+            'rate_limited': self.rate_limited,
+            'retries': self.retries,
+            'requests_per_minute': round(self.requests.rate * 60, 1) if self.rpm > 0 else None,
+            'cache': cache
+        }
+
+class _Flight:
+    """An LLM request in progress that identical requests can wait for"""
+
+    def __init__(self, future: asyncio.Future, owned: bool):
+        self.future = future
+        self.owned = owned  # Run as a task of its own rather than by the first caller's stream
+        self.waiters = 0
+
+class LLMGateway:
+    """Routes each node's LLM calls to a pool of configured model clients
+
+    Identical in-flight requests on the same route share one call. A call that
+    hasn't answered after `hedge_after` seconds is raced against the route's next
+    client, and a client that fails after its retries falls over to the next one.
+    """
+
+    def __init__(self, clients: Dict[str, ModelClient], routes: Dict[str, List[str]],
+                 default: str, hedge_after: float = 0.0):
+        self.clients = clients
+        self.routes = routes
+        self.default = default
+        self.hedge_after = hedge_after
+        self._inflight: Dict[Tuple, _Flight] = {}
+        self.coalesced = 0
+        self.hedged = 0
+
+    def route(self, role: str) -> List[ModelClient]:
+        """Clients for a role, in order of preference; developer_small falls back to developer"""
+        while role:
+            if role in self.routes:
+                return [self.clients[name] for name in self.routes[role]]
+            role = role.rpartition('_')[0]
+        return [self.clients[name] for name in self.routes.get('default', [self.default])]
+
+    def _key(self, route: List[ModelClient], messages) -> Tuple:
+        return tuple(client.name for client in route), cache_key(messages, {})
+
+    def _join(self, key: Tuple) -> Optional[_Flight]:
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            LLM_COALESCED.inc()
+        return flight
+
+    def _track(self, key: Tuple, flight: _Flight):
+        self._inflight[key] = flight
+        flight.future.add_done_callback(
+            lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is flight else None
+        )
+
+    async def _wait(self, flight: _Flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        finally:
+            flight.waiters -= 1
+            # Nobody is left to use the answer
+            if flight.owned and not flight.waiters and not flight.future.done():
+                flight.future.cancel()
+
+    async def _invoke_route(self, route: List[ModelClient], messages, **kwargs):
+        spare = iter(route[1:])
+        pending = {asyncio.ensure_future(self._invoke_client(route[0], messages, **kwargs))}
+        hedged = False
+        error = None
+        try:
+            while pending:
+                timeout = self.hedge_after if self.hedge_after > 0 and not hedged else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    # With a single client the hedge repeats the request on it
+                    client = next(spare, None) if len(route) > 1 else route[0]
+                    if client is not None:
+                        self.hedged += 1
+                        LLM_HEDGES.inc(client=client.name)
+                        logger.info(f"Hedging slow LLM call on '{client.name}'")
+                        pending.add(asyncio.ensure_future(self._invoke_client(client, messages, **kwargs)))
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    client = next(spare, None)
+                    if client is not None:
+                        logger.warning(f"LLM call failed ({error}); falling over to '{client.name}'")
+                        pending.add(asyncio.ensure_future(self._invoke_client(client, messages, **kwargs)))
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _invoke_client(self, client: ModelClient, messages, defer_cache: bool = False, **kwargs):
+        if isinstance(client.cached, CachedLLM):
+            return await client.cached.ainvoke(messages, defer_cache=defer_cache, **kwargs)
+        return await client.ainvoke(messages, **kwargs)
+
+    async def ainvoke(self, messages, role: str = "default", **kwargs):
+        """Response from the role's route; with defer_cache=True it is only cached once confirm()ed"""
+        route = self.route(role)
+        key = self._key(route, messages)
+        flight = self._join(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(self._invoke_route(route, messages, **kwargs)), owned=True)
+            self._track(key, flight)
+        response = await self._wait(flight)
+        if response is None:
+            # Joined a stream whose caller went away before it finished
+            return await self._invoke_route(route, messages, **kwargs)
+        return response
+
+    async def confirm(self, messages, role: str = "default"):
+        """Cache a deferred response to messages now that it proved usable"""
+        # Only the client that actually answered holds it
+        for client in self.route(role):
+            if isinstance(client.cached, CachedLLM):
+                await client.cached.confirm(messages)
+
+    async def astream(self, messages, role: str = "default", defer_cache: bool = False, **kwargs):
+        """Stream from the role's route; with defer_cache=True the response is only cached once confirm()ed"""
+        route = self.route(role)
+        key = self._key(route, messages)
+        flight = self._join(key)
+        if flight is not None:
+            response = await self._wait(flight)
+            if response is None:
+                response = await self._invoke_route(route, messages, defer_cache=defer_cache, **kwargs)
+            from langchain_core.messages import AIMessageChunk
+            yield AIMessageChunk(content=response.content, usage_metadata=getattr(response, 'usage_metadata', None))
+            return
+
+        flight = _Flight(asyncio.get_running_loop().create_future(), owned=False)
+        self._track(key, flight)
+        parts, usage = [], None
+        try:
+            for position, client in enumerate(route):
+                started = False
+                try:
+                    stream = (
+                        client.cached.astream(messages, defer_cache=defer_cache, **kwargs)
+                        if isinstance(client.cached, CachedLLM) else client.cached.astream(messages, **kwargs)
+                    )
+                    async for chunk in stream:
+                        started = True
+                        if isinstance(chunk.content, str):
+                            parts.append(chunk.content)
+                        usage = getattr(chunk, 'usage_metadata', None) or usage
+                        yield chunk
+                    break
+                except Exception as e:
+                    # Only fall over while nothing has been streamed yet
+                    if started or position == len(route) - 1:
+                        raise
+                    logger.warning(f"LLM stream failed ({e}); falling over to '{route[position + 1].name}'")
+            from langchain_core.messages import AIMessage
+            flight.future.set_result(AIMessage(content="".join(parts), usage_metadata=usage))
+        except Exception as e:
+            if not flight.future.done():
+                flight.future.set_exception(e)
+                flight.future.exception()  # Waiters are optional; don't warn if there are none
+            raise
+        finally:
+            if not flight.future.done():
+                flight.future.set_result(None)
+
+    async def start(self, prewarm: bool = False):
+        """Build every client's model, and with `prewarm` make a first call to each"""
+        await asyncio.gather(*(client.start(prewarm) for client in self.clients.values()))
+
+    def stats(self) -> dict:
+        return {
+            'clients': {name: client.stats() for name, client in self.clients.items()},
+            'routes': {role: [client.name for client in self.route(role)] for role in self.routes},
+            'in_flight': len(self._inflight),
+            'coalesced': self.coalesced,
+            'hedged': self.hedged
+        }
+
+PROVIDERS = ('google', 'openai', 'fake')
+
+def build_model(config: dict, params: dict):
+    """Chat model for a client config: google (Gemini), openai (any OpenAI-compatible server) or fake"""
+    provider = config.get('provider', 'google').lower()
+    if provider == 'fake':
+        from fake_llm import fake_from_env
+        return fake_from_env(params=params)
+    if provider == 'openai':
+        # Optional: only needed when a client points at an OpenAI-compatible endpoint
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
+            model=params['model'],
+            temperature=params.get('temperature'),
+            max_tokens=params.get('max_output_tokens'),
+            base_url=config.get('base_url'),
+            api_key=os.getenv(config.get('api_key_env', 'OPENAI_API_KEY')) or "not-needed",
+            max_retries=0,  # The gateway retries
+            stream_usage=True
+        )
+    if provider == 'google':
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        api_key = os.getenv(config['api_key_env']) if 'api_key_env' in config else None
+        return ChatGoogleGenerativeAI(
+            **params,
+            **({'google_api_key': api_key} if api_key else {}),
+            max_retries=0,
+            convert_system_message_to_human=False  # Required for Gemini compatibility
+        )
+    raise ValueError(f"Unknown LLM provider '{provider}'")
+
+def build_client(name: str, config: dict, default_params: dict, cache: Optional[CacheBackend]) -> ModelClient:
+    # The model itself is built at start-up, but a bad config should fail straight away
+    if config.get('provider', 'google').lower() not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider '{config['provider']}'")
+    params = dict(default_params)
+    params.update({key: config[key] for key in ('model', 'temperature', 'max_output_tokens') if key in config})
+    client = ModelClient(
+        name, None, params,
+        factory=lambda: build_model(config, params),
+        rpm=float(config.get('rpm', 0)),
+        tpm=float(config.get('tpm', 0)),
+        burst=config.get('burst'),
+        max_concurrency=int(config.get('max_concurrency', 0)),
+        max_retries=int(config.get('max_retries', os.getenv("LLM_MAX_RETRIES", "4"))),
+        backoff_base=float(config.get('backoff_base', os.getenv("LLM_BACKOFF_BASE", "0.5"))),
+        backoff_max=float(config.get('backoff_max', os.getenv("LLM_BACKOFF_MAX", "30")))
+    )
+    # Cache hits are answered before the client's quotas are touched. The fake model is
+    # free and deterministic, so caching it would only hide the pipeline's own cost.
+    if cache is not None and config.get('provider', 'google').lower() != 'fake':
+        client.cached = CachedLLM(client, cache, params=params)
+    return client
+
+def parse_routes(text: str) -> Dict[str, List[str]]:
+    """'planner=pro;developer=flash,pro' -> {'planner': ['pro'], 'developer': ['flash', 'pro']}"""
+    routes = {}
+    for entry in filter(None, (part.strip() for part in text.split(';'))):
+        role, _, names = entry.partition('=')
+        routes[role.strip()] = [name.strip() for name in names.split(',') if name.strip()]
+    return routes
+
+def gateway_from_env(default_params: dict, cache: Optional[CacheBackend]) -> LLMGateway:
+    """Gateway configured by LLM_CLIENTS and LLM_ROUTES, or a single client from AGENT_LLM"""
+    raw = os.getenv("LLM_CLIENTS")
+    if raw:
+        # JSON object, inline or in a file: {"name": {"provider", "model", "rpm", "tpm", ...}}
+        configs = json.loads(open(raw).read() if os.path.isfile(raw) else raw)
+    else:
+        configs = {'default': {
+            'provider': 'fake' if os.getenv("AGENT_LLM", "gemini").lower() == "fake" else 'google',
+            'rpm': os.getenv("LLM_RPM", "0"),
+            'tpm': os.getenv("LLM_TPM", "0"),
+            'max_concurrency': os.getenv("LLM_MAX_CONCURRENCY", "0")
+        }}
+    clients = {name: build_client(name, config, default_params, cache) for name, config in configs.items()}
+
+    routes = parse_routes(os.getenv("LLM_ROUTES", ""))
+    for role, names in routes.items():
+        unknown = [name for name in names if name not in clients]
+        if unknown or not names:
+            raise ValueError(f"LLM_ROUTES: role '{role}' routes to unknown clients {unknown or names}")
+    gateway = LLMGateway(
+        clients, routes, default=next(iter(clients)),
+        hedge_after=float(os.getenv("LLM_HEDGE_AFTER", "0"))
+    )
+    logger.info(f"LLM clients: {', '.join(clients)}; routes: {gateway.stats()['routes'] or 'all to ' + gateway.default}")
+    return gateway
@@ -0,0 +1,198 @@
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds; spans range from sub-millisecond patching to minute-long LLM calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _label_text(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[Tuple[str, str], ...], list] = {}  # key -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket_labels = _label_text(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+                inf_labels = _label_text(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_labels} {count}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+_registry: List = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+SPAN_SECONDS = register(Histogram(
+    "agent_span_seconds",
+    "Time spent in graph nodes, LLM calls, patching and other pipeline stages"
+))
+REQUEST_SECONDS = register(Histogram(
+    "agent_request_seconds",
+    "End-to-end agent request latency"
+))
+LLM_TOKENS = register(Counter(
+    "agent_llm_tokens_total",
+    "Prompt and completion tokens reported by the LLM provider"
+))
+LLM_CACHE_LOOKUPS = register(Counter(
+    "agent_llm_cache_lookups_total",
+    "LLM response cache lookups by result"
+))
+PLAN_STORE_LOOKUPS = register(Counter(
+    "agent_plan_store_lookups_total",
+    "Stored plan lookups by result"
+))
+SPECULATIVE_DRAFTS = register(Counter(
+    "agent_speculative_drafts_total",
+    "Step diffs drafted while the plan was streaming, by outcome"
+))
+EDIT_FORMAT_ATTEMPTS = register(Counter(
+    "agent_edit_format_attempts_total",
+    "Step edits by format, file size and whether the first response applied"
+))
+LLM_CALLS = register(Counter(
+    "agent_llm_calls_total",
+    "Provider calls per LLM client by outcome (ok, rate_limited, transient, error)"
+))
+LLM_COALESCED = register(Counter(
+    "agent_llm_coalesced_total",
+    "LLM requests answered by an identical request already in flight"
+))
+LLM_HEDGES = register(Counter(
+    "agent_llm_hedges_total",
+    "Slow LLM calls raced against a second request, by the client it went to"
+))
+REQUESTS_SHARED = register(Counter(
+    "agent_requests_shared_total",
+    "Agent requests answered by an identical run in flight (coalesced) or a stored result (replayed)"
+))
+RUNS_CANCELLED = register(Counter(
+    "agent_runs_cancelled_total",
+    "Agent runs cancelled because every client waiting for them disconnected"
+))
+REQUESTS = register(Counter(
+    "agent_requests_total",
+    "Agent requests by endpoint and outcome"
+))
+
+# Per-request span collector, set while a request asked for a timing breakdown
+_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "agent_timings", default=None
+)
+
+@contextmanager
+def span(name: str, **labels):
+    """Time a block into agent_span_seconds and the current request's breakdown"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe(elapsed, span=name, **labels)
+        timings = _timings.get()
+        if timings is not None:
+            label = name + "".join(f".{value}" for value in labels.values())
+            timings.append((label, elapsed))
+
+def timed_node(name: str, node):
+    """Wrap an async graph node in a span"""
+    @functools.wraps(node)
+    async def wrapper(state):
+        with span("node", node=name):
+            return await node(state)
+    return wrapper
+
+def record_llm_usage(response, node: str):
+    """Count the tokens a provider reported for one LLM response"""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("input_tokens", 0), node=node, kind="prompt")
+    LLM_TOKENS.inc(usage.get("output_tokens", 0), node=node, kind="completion")
+
+@contextmanager
+def collect_timings():
+    """Collect the spans of the current request; yields a list filled as they finish"""
+    timings: List[Tuple[str, float]] = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+def summarize_timings(timings: List[Tuple[str, float]]) -> dict:
+    summary: Dict[str, dict] = {}
+    for label, elapsed in timings:
+        entry = summary.setdefault(label, {"count": 0, "seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] = round(entry["seconds"] + elapsed, 6)
+    return summary
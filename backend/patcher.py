@@ -0,0 +1,250 @@
+import bisect
+import re
+from typing import Dict, List, Optional, Tuple
+from pydantic import BaseModel
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How far (in lines) a hunk may drift from its stated position
+SEARCH_WINDOW = 200
+
+HUNK_HEADER = re.compile(r'^@@\s*-(\d+)(?:,(\d+))?\s+\+(\d+)(?:,(\d+))?\s*@@')
+
+class PatchError(ValueError):
+    """Raised when a diff cannot be applied cleanly"""
+
+    def __init__(self, message: str, result: Optional["PatchResult"] = None):
+        super().__init__(message)
+        self.result = result
+
+class Hunk(BaseModel):
+    header: str
+    old_start: Optional[int] = None  # 1-based, None when the hunk had no usable header
+    lines: List[Tuple[str, str]] = []  # (op, text) with op in ' ', '-', '+'
+
+    @property
+    def old_lines(self) -> List[str]:
+        return [text for op, text in self.lines if op != '+']
+
+    @property
+    def new_lines(self) -> List[str]:
+        return [text for op, text in self.lines if op != '-']
+
+class HunkResult(BaseModel):
+    index: int
+    header: str
+    applied: bool
+    start: Optional[int] = None  # 0-based line in the original code where the hunk matched
+    offset: int = 0  # Distance between the stated and the matched position
+    fuzz: int = 0  # 0 exact, 1 whitespace-insensitive, 2 outer context lines ignored
+    old_len: int = 0
+    new_len: int = 0
+    error: Optional[str] = None
+
+class PatchResult(BaseModel):
+    code: str
+    hunks: List[HunkResult] = []
+    replaced: bool = False  # The "diff" was a whole-file replacement
+
+    @property
+    def applied(self) -> bool:
+        return all(h.applied for h in self.hunks)
+
+    @property
+    def failed(self) -> List[HunkResult]:
+        return [h for h in self.hunks if not h.applied]
+
+    def describe_failures(self) -> str:
+        return "\n".join(f"Hunk {h.index + 1} ({h.header}): {h.error}" for h in self.failed)
+
+def _is_file_header(lines: List[str], i: int) -> bool:
+    line = lines[i]
+    if line.startswith('--- ') or line == '---':
+        return i + 1 < len(lines) and lines[i + 1].startswith('+++')
+    if line.startswith('+++ ') or line == '+++':
+        return i > 0 and lines[i - 1].startswith('---')
+    return line.startswith('diff --git') or line.startswith('index ')
+
+def parse_hunks(diff: str) -> List[Hunk]:
+    """Parse unified diff hunks, tolerating the usual LLM formatting slips"""
+    lines = diff.strip('\n').split('\n')
+    hunks = []
+    current = None
+
+    for i, line in enumerate(lines):
+        if _is_file_header(lines, i):
+            current = None
+            continue
+
+        if line.startswith('@@'):
+            match = HUNK_HEADER.match(line)
+            current = Hunk(header=line.strip(), old_start=int(match.group(1)) if match else None)
+            hunks.append(current)
+            continue
+
+        if line.startswith('\\'):
+            # "\ No newline at end of file"
+            continue
+
+        if current is None:
+            if line[:1] not in ('+', '-', ' '):
+                continue
+            # Hunk body without a header: location must be found by content
+            current = Hunk(header='@@ (no header) @@')
+            hunks.append(current)
+
+        if line[:1] in ('+', '-', ' '):
+            current.lines.append((line[0], line[1:]))
+        else:
+            # Blank context lines often lose their leading space
+            current.lines.append((' ', line))
+
+    # Trailing blank context lines are usually just padding after the diff
+    for hunk in hunks:
+        while hunk.lines and hunk.lines[-1] == (' ', ''):
+            hunk.lines.pop()
+
+    return [hunk for hunk in hunks if any(op != ' ' for op, _ in hunk.lines)]
+
+def _normalize(line: str, fuzz: int) -> str:
+    return line if fuzz == 0 else line.strip()
+
+class _LineIndex:
+    """Positions of each (normalized) line, built once per patch"""
+
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        self._positions: Dict[int, Dict[str, List[int]]] = {}
+
+    def positions(self, line: str, fuzz: int) -> List[int]:
+        level = min(fuzz, 1)
+        if level not in self._positions:
+            table: Dict[str, List[int]] = {}
+            for i, text in enumerate(self.lines):
+                table.setdefault(_normalize(text, level), []).append(i)
+            self._positions[level] = table
+        return self._positions[level].get(_normalize(line, level), [])
+
+    def matches(self, block: List[str], pos: int, fuzz: int) -> bool:
+        if pos < 0 or pos + len(block) > len(self.lines):
+            return False
+        level = min(fuzz, 1)
+        return all(
+            _normalize(self.lines[pos + k], level) == _normalize(text, level)
+            for k, text in enumerate(block)
+        )
+
+def _trim_context(hunk_lines: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], int]:
+    """Drop one leading and one trailing context line (GNU patch style fuzz), never the last old line"""
+    lines = list(hunk_lines)
+    lead = 0
+    old = sum(1 for op, _ in lines if op != '+')
+    if lines and lines[0][0] == ' ' and old > 1:
+        lines.pop(0)
+        lead = 1
+        old -= 1
+    if lines and lines[-1][0] == ' ' and old > 1:
+        lines.pop()
+    return lines, lead
+
+def _locate(index: _LineIndex, block: List[str], expected: Optional[int], lo: int, fuzz: int) -> Optional[int]:
+    """Find the matching position closest to expected within the search window"""
+    candidates = index.positions(block[0], fuzz)
+    if expected is None:
+        hits = [p for p in candidates[bisect.bisect_left(candidates, lo):] if index.matches(block, p, fuzz)]
+        return hits[0] if len(hits) == 1 else None
+
+    start = bisect.bisect_left(candidates, max(lo, expected - SEARCH_WINDOW))
+    end = bisect.bisect_right(candidates, expected + SEARCH_WINDOW)
+    best = None
+    for pos in candidates[start:end]:
+        if index.matches(block, pos, fuzz) and (best is None or abs(pos - expected) < abs(best - expected)):
+            best = pos
+    if best is not None:
+        return best
+
+    # Line numbers from an LLM can be far off; accept a match elsewhere only if it is unique
+    return _locate(index, block, None, lo, fuzz)
+
+def apply_patch(current_code: str, diff: str, allow_replace: bool = False) -> PatchResult:
+    """Apply every hunk of a unified diff in one pass, reporting each hunk's outcome
+
+    Text without any hunks is an error, unless allow_replace takes it as the whole new file.
+    """
+    hunks = parse_hunks(diff)
+    if not hunks:
+        if '@@' in diff:
+            raise PatchError("Diff contains no applicable hunks")
+        if not allow_replace:
+            raise PatchError("No diff hunks found")
+        # No diff markers at all: the model returned the whole file
+        return PatchResult(code=diff.strip('\n') + ('\n' if current_code.endswith('\n') else ''), replaced=True)
+
+    lines = current_code.split('\n')
+    index = _LineIndex(lines)
+    output: List[str] = []
+    results: List[HunkResult] = []
+    cursor = 0  # Next unconsumed line of the original code
+    drift = 0  # Offset observed on the previous hunk, applied to the next one
+
+    ordered = sorted(enumerate(hunks), key=lambda item: (item[1].old_start is None, item[1].old_start or 0))
+    for i, hunk in ordered:
+        # 0-based line the hunk starts at; a pure insertion's old start is the line it goes after
+        stated = None
+        if hunk.old_start is not None:
+            stated = hunk.old_start if not hunk.old_lines else hunk.old_start - 1
+        expected = None if stated is None else max(0, stated + drift)
+        result = HunkResult(index=i, header=hunk.header, applied=False)
+
+        found = None
+        insertion = all(op == '+' for op, _ in hunk.lines)
+        for fuzz in (0, 1, 2):
+            hunk_lines, lead = (hunk.lines, 0) if fuzz < 2 else _trim_context(hunk.lines)
+            block = [text for op, text in hunk_lines if op != '+']
+            if insertion:
+                # Pure insertion: trust the stated position
+                if expected is not None and cursor <= expected <= len(lines):
+                    found = (expected, hunk_lines, fuzz)
+                break
+            shifted = None if expected is None else expected + lead
+            pos = _locate(index, block, shifted, cursor, fuzz)
+            if pos is not None:
+                found = (pos, hunk_lines, fuzz)
+                break
+
+        if found is None:
+            result.error = "context not found near line " + (str(hunk.old_start) if hunk.old_start else "?")
+            results.append(result)
+            continue
+
+        pos, hunk_lines, fuzz = found
+        output.extend(lines[cursor:pos])
+        j = pos
+        for op, text in hunk_lines:
+            if op == '+':
+                output.append(text)
+            else:
+                if op == ' ':
+                    output.append(lines[j])  # Keep the file's own whitespace
+                j += 1
+
+        result.applied = True
+        result.start = pos
+        result.fuzz = fuzz
+        result.old_len = j - pos
+        result.new_len = sum(1 for op, _ in hunk_lines if op != '-')
+        if expected is not None:
+            result.offset = pos - stated
+            drift = result.offset
+        results.append(result)
+        cursor = j
+
+    output.extend(lines[cursor:])
+    results.sort(key=lambda h: h.index)
+    patch_result = PatchResult(code='\n'.join(output), hunks=results)
+    logger.info(
+        f"Applied {len(results) - len(patch_result.failed)}/{len(results)} hunks "
+        f"to {len(lines)} lines"
+    )
+    return patch_result
@@ -0,0 +1,158 @@
+import difflib
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import FrozenSet, List, Optional, Tuple
+from code_index import get_index
+from metrics import PLAN_STORE_LOOKUPS
+import logging
+
+logger = logging.getLogger(__name__)
+
+def normalize_instruction(instruction: str) -> str:
+    """Case, whitespace and trailing punctuation don't change what a task asks for"""
+    return re.sub(r'\s+', ' ', instruction.lower()).strip().rstrip('.!?;: ')
+
+def code_outline(code: str) -> FrozenSet[Tuple[str, str, str]]:
+    """Fingerprint of code: its classes, functions and methods, each with a hash of its own source"""
+    # Bodies are hashed so files that merely share names (every script's `main`) never match;
+    # a class hashes only its own lines, since its methods are compared on their own
+    lines = code.split('\n')
+    symbols = [symbol for symbol in get_index(code).symbols if symbol.kind in ('class', 'function', 'method')]
+    outline = set()
+    for symbol in symbols:
+        nested = [(inner.start, inner.end) for inner in symbols if inner.parent == symbol.qualname]
+        own = "\n".join(
+            lines[number - 1].strip() for number in range(symbol.start, min(symbol.end, len(lines)) + 1)
+            if not any(start <= number <= end for start, end in nested)
+        )
+        outline.add((symbol.kind, symbol.qualname, hashlib.sha256(own.encode('utf-8')).hexdigest()[:16]))
+    return frozenset(outline)
+
+def similarity(a: FrozenSet, b: FrozenSet) -> float:
+    # Two files without any definitions share no structure, whatever they contain
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def step_anchors(steps: List[str], code: str) -> FrozenSet[str]:
+    """Names of the code's symbols that the plan steps refer to"""
+    symbols = get_index(code).block_of()
+    return frozenset(
+        name for step in steps for name in re.findall(r'[A-Za-z_]\w*', step) if name in symbols
+    )
+
+class PlanEntry:
+    def __init__(self, instruction: str, outline: FrozenSet, steps: List[str], anchors: FrozenSet[str]):
+        self.instruction = instruction
+        self.outline = outline
+        self.steps = steps
+        self.anchors = anchors
+        self.stored_at = time.time()
+
+class PlanStore:
+    """Recent plans, reused for the same task on structurally similar code"""
+
+    def __init__(self, max_entries: int = 256, ttl: Optional[float] = 3600,
+                 code_similarity: float = 0.8, instruction_similarity: float = 1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.code_similarity = code_similarity
+        # 1.0 only matches identical instructions after normalization
+        self.instruction_similarity = instruction_similarity
+        self._entries: "OrderedDict[int, PlanEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, entry: PlanEntry, now: float) -> bool:
+        return self.ttl is not None and now - entry.stored_at > self.ttl
+
+    def _instruction_matches(self, stored: str, instruction: str) -> bool:
+        if stored == instruction:
+            return True
+        if self.instruction_similarity >= 1.0:
+            return False
+        return difflib.SequenceMatcher(None, stored, instruction).ratio() >= self.instruction_similarity
+
+    def lookup(self, instruction: str, code: str) -> Optional[List[str]]:
+        """Steps of the closest stored plan for this task, if one is close enough"""
+        index = get_index(code)
+        if not index.valid:
+            return None  # No structure to compare
+        outline = code_outline(code)
+        if not outline:
+            return None  # Nor here: plain scripts only have their content
+        instruction = normalize_instruction(instruction)
+        symbols = index.block_of()
+        now = time.time()
+
+        best_id, best_score = None, -1.0
+        with self._lock:
+            for entry_id, entry in list(self._entries.items()):
+                if self._expired(entry, now):
+                    del self._entries[entry_id]
+                    continue
+                if not self._instruction_matches(entry.instruction, instruction):
+                    continue
+                score = similarity(entry.outline, outline)
+                # Steps naming symbols that are gone would point the developer at nothing
+                if score >= self.code_similarity and score > best_score and entry.anchors.issubset(symbols):
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                PLAN_STORE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            PLAN_STORE_LOOKUPS.inc(result="hit")
+            steps = list(self._entries[best_id].steps)
+        logger.info(f"Reusing stored plan (code similarity {best_score:.2f})")
+        return steps
+
+    def remember(self, instruction: str, code: str, steps: List[str]):
+        if not get_index(code).valid:
+            return
+        outline = code_outline(code)
+        if not outline:
+            return  # lookup() never reuses plans for code without definitions
+        entry = PlanEntry(normalize_instruction(instruction), outline, list(steps), step_anchors(steps, code))
+        with self._lock:
+            # A newer plan for the same task and structure replaces the old one
+            for entry_id, stored in list(self._entries.items()):
+                if stored.instruction == entry.instruction and stored.outline == entry.outline:
+                    del self._entries[entry_id]
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries)
+        }
+
+def plan_store_from_env() -> Optional[PlanStore]:
+    """Plan store configured by PLAN_STORE_* variables, or None if PLAN_STORE=off"""
+    if os.getenv("PLAN_STORE", "on").lower() in ("off", "none", "0", "false"):
+        return None
+    return PlanStore(
+        max_entries=int(os.getenv("PLAN_STORE_MAX_ENTRIES", "256")),
+        ttl=float(os.getenv("PLAN_STORE_TTL", "3600")) or None,
+        code_similarity=float(os.getenv("PLAN_REUSE_CODE_SIMILARITY", "0.8")),
+        instruction_similarity=float(os.getenv("PLAN_REUSE_INSTRUCTION_SIMILARITY", "1.0"))
+    )
+
+plan_store = plan_store_from_env()
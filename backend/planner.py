@@ -2,93 +2,252 @@ from tools import search_internal, search_external, llm
 from langchain_core.messages import SystemMessage, HumanMessage
 import re
 from state import PlannerState, AgentState, DeveloperState
+from metrics import span, record_llm_usage
+from code_index import get_index
+from plan_store import plan_store
+from workspace import WorkspaceHistory, rank_files, read
+from developer import speculative_dispatcher
+import speculation
+from typing import Callable, List, Optional, Tuple
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
-def planner_node(state: AgentState) -> AgentState:
+# Files and symbols per file shown when planning one task for many files
+SHARED_PLAN_SAMPLE_FILES = 5
+SHARED_PLAN_OUTLINE_SYMBOLS = 30
+
+# Workspace plans show the most relevant files in full up to this many tokens (~4 characters
+# each), outline a few more and list some paths; the rest of the project is only counted
+WORKSPACE_CONTEXT_TOKENS = int(os.getenv("WORKSPACE_CONTEXT_TOKENS", "6000"))
+WORKSPACE_OUTLINE_FILES = int(os.getenv("WORKSPACE_OUTLINE_FILES", "10"))
+WORKSPACE_LISTED_FILES = 50
+
+def parse_steps(response: str) -> List[str]:
+    """Plan steps from a numbered or bulleted LLM response"""
+    # Clean up steps - remove numbering and formatting
+    lines = response.split('\n')
+    steps = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            # Remove markdown formatting and numbering
+            cleaned = re.sub(r'^\d+[\.\)]\s*', '', line)
+            cleaned = re.sub(r'^\*+\s*', '', cleaned)
+            cleaned = re.sub(r'^\-\s*', '', cleaned)
+            cleaned = cleaned.strip('*').strip()
+            if cleaned and not cleaned.startswith('**') and len(cleaned) > 10:
+                steps.append(cleaned)
+    return steps
+
+def outline(code: str) -> str:
+    """Top-level shape of a file: its classes, functions and methods"""
+    symbols = [
+        f"{symbol.kind} {symbol.qualname}"
+        for symbol in get_index(code).symbols
+        if symbol.kind in ('class', 'function', 'method')
+    ]
+    shown = symbols[:SHARED_PLAN_OUTLINE_SYMBOLS]
+    if len(symbols) > len(shown):
+        shown.append(f"... {len(symbols) - len(shown)} more")
+    return "\n".join(shown) or "(no functions or classes)"
+
+async def plan_shared(user_task: str, files: List[Tuple[str, str]]) -> List[str]:
+    """One plan for applying the same task to each of several (filename, code) files"""
+    sample = files[:SHARED_PLAN_SAMPLE_FILES]
+    outlines = "\n\n".join(f"File {name}:\n{outline(code)}" for name, code in sample)
+    if len(files) > len(sample):
+        outlines += f"\n\n... and {len(files) - len(sample)} more files"
+    
+    prompt = [
+        SystemMessage(content=(
+            "You are a Senior Software Architect. Break the task into 2-4 atomic steps. "
+            "The same plan will be applied to each file on its own, so every step must make "
+            "sense for any of them: describe the change generally and do not name functions "
+            "that only exist in one file. "
+            "Output format:\n"
+            "1. Step description\n"
+            "2. Step description\n"
+        )),
+        HumanMessage(content=(
+            f"Task: {user_task}\n"
+            f"Files:\n{outlines}\n\n"
+            "Step-by-step Plan:"
+        ))
+    ]
+    
+    with span("llm", node="planner"):
+        message = await llm.ainvoke(prompt, role="planner", defer_cache=True)
+    record_llm_usage(message, "planner")
+    steps = parse_steps(message.content)
+    if steps:
+        await llm.confirm(prompt, role="planner")
+    logger.info(f"Shared plan for {len(files)} files: {steps}")
+    return steps
+
+def workspace_context(user_task: str, workspace: WorkspaceHistory) -> str:
+    """The project as the planner sees it, sized by what the task touches rather than the project"""
+    tree = workspace.tree()
+    ranked = rank_files(tree, user_task)
+    budget = WORKSPACE_CONTEXT_TOKENS * 4
+    parts = []
+    shown = set()
+    for path in ranked:
+        code = read(tree, path)
+        if len(code) > budget:
+            continue
+        parts.append(f"File {path}:\n```python\n{code}\n```")
+        budget -= len(code)
+        shown.add(path)
+    
+    rest = [path for path in ranked if path not in shown] + sorted(set(tree) - set(ranked))
+    outlined = rest[:WORKSPACE_OUTLINE_FILES]
+    for path in outlined:
+        parts.append(f"File {path} (outline):\n{outline(read(tree, path))}")
+    listed = rest[len(outlined):len(outlined) + WORKSPACE_LISTED_FILES]
+    if listed:
+        parts.append("Other files: " + ", ".join(listed))
+    hidden = len(rest) - len(outlined) - len(listed)
+    if hidden:
+        parts.append(f"... and {hidden} more files")
+    return "\n\n".join(parts)
+
+async def plan_workspace(user_task: str, workspace: WorkspaceHistory) -> List[str]:
+    """Plan a task across the files of a workspace; every step names the one file it changes"""
+    with span("workspace_context"):
+        context = workspace_context(user_task, workspace)
+    
+    prompt = [
+        SystemMessage(content=(
+            "You are a Senior Software Architect. Break the task into 2-6 atomic steps. "
+            "Each step changes exactly one file and starts with that file's path, e.g. "
+            "'pkg/util.py: Add a helper ...'. A step may create a new file. "
+            "Only the most relevant files are shown in full. "
+            "Output format:\n"
+            "1. path/to/file.py: Step description\n"
+            "2. path/to/file.py: Step description\n"
+        )),
+        HumanMessage(content=(
+            f"Task: {user_task}\n"
+            f"Project files:\n{context}\n\n"
+            "Step-by-step Plan:"
+        ))
+    ]
+    
+    with span("llm", node="planner"):
+        message = await llm.ainvoke(prompt, role="planner", defer_cache=True)
+    record_llm_usage(message, "planner")
+    steps = parse_steps(message.content)
+    if steps:
+        await llm.confirm(prompt, role="planner")
+    logger.info(f"Workspace plan over {len(workspace.tree())} files: {steps}")
+    return steps
+
+async def plan_with_llm(user_task: str, current_code: str,
+                        on_step: Optional[Callable[[str], None]] = None) -> List[str]:
+    """Ask the LLM for a plan for the task on the current code, reporting steps as they stream in"""
+    with span("search_internal"):
+        ctx_i = search_internal(user_task, current_code)
+    ctx_e = search_external(user_task)
+    
+    prompt = [
+        SystemMessage(content=(
+            "You are a Senior Software Architect. Break the task into 2-4 atomic steps. "
+            "Each step should be implementable with a code diff. "
+            "Focus on concrete code changes, not analysis tasks. "
+            "Output format:\n"
+            "1. Step description\n"
+            "2. Step description\n"
+        )),
+        HumanMessage(content=(
+            f"Task: {user_task}\n"
+            f"Current Code:\n```python\n{current_code}\n```\n"
+            f"Internal Context: {ctx_i}\n"
+            f"External Context: {ctx_e}\n\n"
+            "Step-by-step Plan:"
+        ))
+    ]
+    
+    message = None
+    dispatched = 0
+    with span("llm", node="planner"):
+        async for chunk in llm.astream(prompt, role="planner", defer_cache=True):
+            message = chunk if message is None else message + chunk
+            if on_step is not None:
+                # A step is complete once the line after it has started
+                text = message.content
+                complete = parse_steps(text[:text.rfind('\n') + 1])
+                for step in complete[dispatched:]:
+                    on_step(step)
+                dispatched = len(complete)
+    record_llm_usage(message, "planner")
+    response = message.content if message is not None else ""
+    logger.info(f"Planner response: {response}")
+    
+    steps = parse_steps(response)
+    if steps:
+        # Only a response that yields a plan is worth replaying
+        await llm.confirm(prompt, role="planner")
+    if on_step is not None:
+        for step in steps[dispatched:]:
+            on_step(step)
+    
+    logger.info(f"Extracted {len(steps)} steps: {steps}")
+    return steps
+
+async def planner_node(state: AgentState) -> dict:
     try:
         if not state.planner.plan_steps:
             current_code = state.code_history[-1] if state.code_history else ""
             
             logger.info(f"Planning for task: {state.planner.user_task}")
             
-            ctx_i = search_internal(state.planner.user_task, current_code)
-            ctx_e = search_external(state.planner.user_task)
-            
-            prompt = [
-                SystemMessage(content=(
-                    "You are a Senior Software Architect. Break the task into 2-4 atomic steps. "
-                    "Each step should be implementable with a code diff. "
-                    "Focus on concrete code changes, not analysis tasks. "
-                    "Output format:\n"
-                    "1. Step description\n"
-                    "2. Step description\n"
-                )),
-                HumanMessage(content=(
-                    f"Task: {state.planner.user_task}\n"
-                    f"Current Code:\n```python\n{current_code}\n```\n"
-                    f"Internal Context: {ctx_i}\n"
-                    f"External Context: {ctx_e}\n\n"
-                    "Step-by-step Plan:"
-                ))
-            ]
-            
-            response = llm.invoke(prompt).content
-            logger.info(f"Planner response: {response}")
+            steps = None
+            if state.workspace:
+                steps = await plan_workspace(state.planner.user_task, state.workspace)
+            elif plan_store is not None:
+                # Iterative edits usually repeat a task on barely changed code
+                with span("plan_store"):
+                    steps = plan_store.lookup(state.planner.user_task, current_code)
             
-            # Clean up steps - remove numbering and formatting
-            lines = response.split('\n')
-            steps = []
-            for line in lines:
-                line = line.strip()
-                if line:
-                    # Remove markdown formatting and numbering
-                    cleaned = re.sub(r'^\d+[\.\)]\s*', '', line)
-                    cleaned = re.sub(r'^\*+\s*', '', cleaned)
-                    cleaned = re.sub(r'^\-\s*', '', cleaned)
-                    cleaned = cleaned.strip('*').strip()
-                    if cleaned and not cleaned.startswith('**') and len(cleaned) > 10:
-                        steps.append(cleaned)
+            if not steps and not state.workspace:
+                # Start drafting early steps while the rest of the plan is still streaming
+                on_step = None
+                if not (state.developer.run_code or state.developer.tests):
+                    on_step = speculative_dispatcher(current_code)
+                try:
+                    steps = await plan_with_llm(state.planner.user_task, current_code, on_step)
+                except BaseException:
+                    # Including cancellation, when every client waiting for the run has gone
+                    speculation.discard(current_code)
+                    raise
+                if steps and plan_store is not None:
+                    plan_store.remember(state.planner.user_task, current_code, steps)
             
-            logger.info(f"Extracted {len(steps)} steps: {steps}")
-            
-            # Return updated AgentState with new PlannerState and reset DeveloperState
-            return AgentState(
-                planner=PlannerState(
+            # Only the planner and a reset developer change; the code history is untouched
+            return {
+                'planner': PlannerState(
                     user_task=state.planner.user_task,
                     plan_steps=steps,
                     planner_done=True
                 ),
-                developer=DeveloperState(
+                'developer': DeveloperState(
                     plan_steps=steps,  # Pass steps to developer
                     current_idx=0,
                     code_after="",
-                    developer_done=False
-                ),
-                code_history=state.code_history
-            )
+                    developer_done=False,
+                    run_code=state.developer.run_code,
+                    tests=state.developer.tests
+                )
+            }
         
         # Mark planner as done if steps already exist
-        return AgentState(
-            planner=PlannerState(
-                user_task=state.planner.user_task,
-                plan_steps=state.planner.plan_steps,
-                planner_done=True
-            ),
-            developer=state.developer,
-            code_history=state.code_history
-        )
+        return {'planner': state.planner.model_copy(update={'planner_done': True, 'error': None})}
     
     except Exception as e:
         logger.error(f"Planner error: {str(e)}")
-        return AgentState(
-            planner=PlannerState(
-                user_task=state.planner.user_task,
-                plan_steps=state.planner.plan_steps,
-                planner_done=True,
-                error=f"Planner error: {str(e)}"
-            ),
-            developer=state.developer,
-            code_history=state.code_history
-        )
\ No newline at end of file
+        return {'planner': state.planner.model_copy(update={
+            'planner_done': True,
+            'error': f"Planner error: {str(e)}"
+        })}
@@ -0,0 +1,201 @@
+import ast
+import asyncio
+import json
+import os
+import shlex
+import shutil
+import sys
+import uuid
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+import logging
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+# Warm worker processes; each runs one job at a time in a fresh, limited child
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", "2"))
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", "5"))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "5"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+# Running submitted code (POST /execute, run_code and tests) is opt-in: anyone who can
+# reach the server could otherwise run code on it
+CODE_EXECUTION = os.getenv("ENABLE_CODE_EXECUTION", "0") == "1"
+# Command workers run under; it must leave them without network access and let them create a
+# mount namespace (both checked at start-up). The default is a new user and network namespace,
+# whose only interface is a down loopback; workers then remount the filesystem privately
+SANDBOX_LAUNCHER = os.getenv("SANDBOX_LAUNCHER", "unshare --user --map-root-user --net")
+# 0 when the launcher already gives workers their own filesystem view (e.g. bwrap with read-only binds)
+SANDBOX_PRIVATE_FS = os.getenv("SANDBOX_PRIVATE_FS", "1") == "1"
+
+# Workers get none of the server's environment, so no provider keys or other secrets
+WORKER_ENV = {'PATH': os.defpath, 'LANG': 'C.UTF-8'}
+# Hidden from submitted code: the project (its .env, sources and databases), the server's working
+# directory and home, plus any SANDBOX_PRIVATE_DIRS. Everything else is read-only to it
+BACKEND_DIR = os.path.dirname(WORKER_SCRIPT)
+PRIVATE_DIRS = [os.path.dirname(BACKEND_DIR), BACKEND_DIR, os.getcwd(), os.path.expanduser("~")] + [
+    path for path in os.getenv("SANDBOX_PRIVATE_DIRS", "").split(os.pathsep) if path
+]
+
+class SandboxError(Exception):
+    """Raised when code execution is unavailable"""
+
+class SandboxResult(BaseModel):
+    ok: bool
+    stage: Optional[str] = None  # Where it failed: run, tests, timeout, limits or sandbox
+    error: Optional[str] = None
+    stdout: str = ""
+    passed: List[str] = []  # Names of passing test functions
+    failed: Dict[str, str] = {}  # Failing test function -> traceback
+    seconds: float = 0.0
+
+    def describe(self) -> str:
+        """Failure report suitable for feeding back to the LLM"""
+        if self.ok:
+            return "All checks passed"
+        parts = [self.error] if self.error else []
+        parts.extend(f"{name} failed:\n{trace}" for name, trace in self.failed.items())
+        return "\n".join(parts)
+
+def syntax_error(code: str) -> Optional[str]:
+    """Description of the first syntax error in code, or None if it parses"""
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        line = (e.text or "").rstrip()
+        return f"line {e.lineno}: {e.msg}" + (f"\n    {line}" if line else "")
+    return None
+
+class SandboxPool:
+    """Pre-started Python worker processes that run untrusted code under resource limits"""
+
+    def __init__(self, workers: int, timeout: float, cpu_seconds: int, memory_mb: int,
+                 launcher: str = SANDBOX_LAUNCHER):
+        self.size = workers
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.launcher = shlex.split(launcher)
+        self._idle: Optional[asyncio.Queue] = None
+
+    def _command(self, *args: str) -> List[str]:
+        command = [*self.launcher, sys.executable, "-I", WORKER_SCRIPT]
+        for path in PRIVATE_DIRS:
+            command += ["--private", os.path.realpath(path)]
+        if not SANDBOX_PRIVATE_FS:
+            command.append("--shared-fs")
+        return command + list(args)
+
+    async def _check_isolation(self):
+        """Refuse to run anything unless workers are cut off the network and the server's files"""
+        if not self.launcher or shutil.which(self.launcher[0]) is None:
+            raise SandboxError(f"Sandbox launcher {self.launcher[:1]} is not available, so workers cannot be isolated")
+        # A worker that sets itself up as usual, then checks what it can still reach
+        token = f".sandbox-probe-{uuid.uuid4().hex}"
+        checked = sorted({os.path.realpath(os.getcwd()), BACKEND_DIR})
+        probe = await asyncio.create_subprocess_exec(
+            *self._command("--probe", token, *checked),
+            env=WORKER_ENV,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        isolated = await probe.wait() == 0
+        for path in checked:
+            marker = os.path.join(path, token)
+            if os.path.exists(marker):
+                os.remove(marker)
+                isolated = False
+        if not isolated:
+            raise SandboxError(
+                "Sandbox workers could reach the network or the server's files; refusing to start them "
+                "(see SANDBOX_LAUNCHER)"
+            )
+
+    async def _spawn(self):
+        return await asyncio.create_subprocess_exec(
+            *self._command(),
+            env=WORKER_ENV,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=1 << 20
+        )
+
+    async def start(self):
+        await self._check_isolation()
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._idle.put_nowait(await self._spawn())
+        logger.info(f"Started {self.size} sandbox workers")
+
+    async def run(self, code: str, tests: Optional[str] = None) -> SandboxResult:
+        """Execute code (then tests, if given) in the next free worker"""
+        job = {
+            'code': code,
+            'tests': tests,
+            'timeout': self.timeout,
+            'cpu_seconds': self.cpu_seconds,
+            'memory_mb': self.memory_mb
+        }
+        worker = await self._idle.get()
+        try:
+            worker.stdin.write((json.dumps(job) + "\n").encode("utf-8"))
+            await worker.stdin.drain()
+            # The worker enforces the timeout itself; this only guards against a stuck worker
+            line = await asyncio.wait_for(worker.stdout.readline(), self.timeout + 5)
+            if not line:
+                raise ConnectionError("sandbox worker exited")
+            return SandboxResult(**json.loads(line))
+        except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            logger.error(f"Sandbox worker failed, replacing it: {e}")
+            if worker.returncode is None:
+                worker.kill()
+            await worker.wait()
+            worker = await self._spawn()
+            return SandboxResult(ok=False, stage="sandbox", error=f"Sandbox worker failed: {e}")
+        finally:
+            self._idle.put_nowait(worker)
+
+    async def close(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            worker.stdin.close()
+            try:
+                await asyncio.wait_for(worker.wait(), 2)
+            except asyncio.TimeoutError:
+                worker.kill()
+                await worker.wait()
+        self._idle = None
+
+_pool: Optional[SandboxPool] = None
+_pool_started: Optional[asyncio.Task] = None
+
+async def get_pool() -> SandboxPool:
+    """The process-wide sandbox pool, started on first use"""
+    global _pool, _pool_started
+    if not CODE_EXECUTION:
+        raise SandboxError("Code execution is disabled (set ENABLE_CODE_EXECUTION=1)")
+    if SANDBOX_WORKERS <= 0:
+        raise SandboxError("Code execution is disabled (SANDBOX_WORKERS=0)")
+    if not hasattr(os, "fork"):
+        raise SandboxError("Code execution needs a Unix host")
+    if _pool is None:
+        # Concurrent first callers all wait on the same start-up
+        _pool = SandboxPool(SANDBOX_WORKERS, SANDBOX_TIMEOUT, SANDBOX_CPU_SECONDS, SANDBOX_MEMORY_MB)
+        _pool_started = asyncio.ensure_future(_pool.start())
+    await _pool_started
+    return _pool
+
+async def close_pool():
+    global _pool, _pool_started
+    if _pool is not None:
+        try:
+            await _pool_started
+        except SandboxError:
+            pass  # Never started; close() has nothing to stop
+        await _pool.close()
+        _pool = None
+        _pool_started = None
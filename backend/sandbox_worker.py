@@ -0,0 +1,275 @@
+"""Warm sandbox worker: reads jobs as JSON lines on stdin, answers one JSON line each
+
+Started by sandbox.py with `python -I`, so it only relies on the standard library, under a
+launcher that has already cut it off the network and with an environment holding no secrets.
+Before reading any job it gives itself a private view of the filesystem (see _isolate). The
+worker itself never runs submitted code; it forks a child per job, and the child applies its
+resource limits before executing anything.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import io
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+MAX_OUTPUT = 4000  # Characters of captured output and tracebacks sent back
+MAX_FILE_BYTES = 1 << 20
+
+# mount(2) and unshare(2) flags
+MS_RDONLY = 1
+MS_REMOUNT = 32
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MNT_DETACH = 2
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+
+def _short_traceback(limit: int = 6) -> str:
+    """Current exception's traceback without the worker's own frames"""
+    exc = traceback.TracebackException(*sys.exc_info())
+    frames = [frame for frame in exc.stack if frame.filename != __file__]
+    exc.stack = traceback.StackSummary.from_list(frames[-limit:])
+    return "".join(exc.format())[-MAX_OUTPUT:]
+
+def _libc():
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+def _mount(source, target: str, fstype, flags: int, data=None):
+    encode = lambda value: value.encode() if value is not None else None
+    if _libc().mount(encode(source), encode(target), encode(fstype), flags, encode(data)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"mount {target}: {os.strerror(error)}")
+
+def _unshare(flags: int, what: str):
+    if _libc().unshare(flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"Cannot create a {what}: {os.strerror(error)}")
+
+def _private_mounts():
+    """Move into a mount namespace of our own, so no mount below can reach the server's view"""
+    _unshare(CLONE_NEWNS, "mount namespace")
+    # Without this, mounts would still propagate back to a shared parent mount
+    _mount(None, '/', None, MS_REC | MS_PRIVATE)
+
+def _inside(path: str, parent: str) -> bool:
+    return path == parent or path.startswith(parent.rstrip('/') + '/')
+
+def _python_dirs():
+    return sorted({os.path.realpath(sys.prefix), os.path.realpath(sys.base_prefix)})
+
+def _isolate(private: list):
+    """Hide the server's directories and make everything else read-only
+
+    Runs in a mount namespace of its own (set up here, which needs the user namespace the
+    launcher creates). Each private directory is covered by an empty tmpfs; the Python
+    installation is mounted back read-only if it lived under one, so submitted code can
+    still import the standard library.
+    """
+    _private_mounts()
+    kept = {path: os.open(path, os.O_RDONLY | os.O_DIRECTORY) for path in _python_dirs()}
+    hidden = []
+    # Shortest first: a directory inside one already hidden has nothing left to hide
+    for path in sorted(set(private), key=len):
+        if path != '/' and os.path.isdir(path):
+            _mount('tmpfs', path, 'tmpfs', 0, 'mode=0755')
+            hidden.append(path)
+    for path, fd in kept.items():
+        if any(_inside(path, parent) for parent in hidden):
+            os.makedirs(path, exist_ok=True)
+            # The kept descriptor still reaches the directory the tmpfs now covers
+            _mount(f'/proc/self/fd/{fd}', path, None, MS_BIND | MS_REC)
+        os.close(fd)
+
+    # Every mount becomes read-only; scratch space is fresh and private
+    with open('/proc/self/mountinfo') as mounts:
+        points = [line.split()[4].replace('\\040', ' ') for line in mounts]
+    for point in points:
+        try:
+            _mount('none', point, None, MS_REMOUNT | MS_BIND | MS_RDONLY)
+        except OSError:
+            if point == '/':
+                raise
+    for scratch in ('/tmp', '/dev/shm'):
+        if os.path.isdir(scratch):
+            _mount('tmpfs', scratch, 'tmpfs', 0, 'mode=1777')
+
+    # A nested, unprivileged user namespace locks all of the above: submitted code can
+    # neither unmount the tmpfs covers nor remount anything writable
+    _unshare(CLONE_NEWUSER | CLONE_NEWNS, "user namespace")
+
+def _probe(checked: list, token: str) -> bool:
+    """Whether a worker is isolated: no network, and the checked server directories out of reach"""
+    if any(name != 'lo' for _, name in socket.if_nameindex()):
+        return False
+    for path in checked:
+        # As submitted code might: try to uncover the directory
+        parent = path
+        while parent != '/':
+            _libc().umount2(parent.encode(), MNT_DETACH)
+            parent = os.path.dirname(parent)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        # Only the way down to the remounted Python installation may show through
+        if any(not any(_inside(python, os.path.join(path, name)) for python in _python_dirs()) for name in names):
+            return False
+        try:
+            # The pool checks this never reaches the real directory
+            with open(os.path.join(path, token), 'w') as marker:
+                marker.write('sandbox probe')
+        except OSError:
+            pass
+    return True
+
+def _restrict(job: dict):
+    """Limits applied in the child before any submitted code runs"""
+    cpu = max(1, int(job['cpu_seconds']))
+    memory = int(job['memory_mb']) << 20
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_BYTES, MAX_FILE_BYTES))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+    try:
+        # No further processes (fork bombs, shelling out); not enforced for root
+        resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    except (ValueError, OSError):
+        pass
+
+    os.chdir(tempfile.mkdtemp(prefix="sandbox-"))
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+def _execute(job: dict) -> dict:
+    """Run the code as module `solution`, then any test_* functions in the tests"""
+    result = {'ok': True, 'stage': None, 'error': None, 'stdout': '', 'passed': [], 'failed': {}}
+    output = io.StringIO()
+    sys.stdout = sys.stderr = output
+    sys.stdin = io.StringIO()
+    try:
+        module = types.ModuleType('solution')
+        module.__file__ = 'solution.py'
+        sys.modules['solution'] = module
+        try:
+            exec(compile(job['code'], 'solution.py', 'exec'), module.__dict__)
+        except BaseException:
+            result.update(ok=False, stage='run', error=_short_traceback())
+            return result
+
+        if job.get('tests'):
+            # Tests see the solution's names directly and can also `import solution`
+            namespace = dict(module.__dict__, __name__='tests', __file__='tests.py')
+            try:
+                exec(compile(job['tests'], 'tests.py', 'exec'), namespace)
+            except BaseException:
+                result.update(ok=False, stage='tests', error=_short_traceback())
+                return result
+            for name, test in list(namespace.items()):
+                if not (name.startswith('test_') and callable(test)):
+                    continue
+                try:
+                    test()
+                    result['passed'].append(name)
+                except BaseException:
+                    result['failed'][name] = _short_traceback(limit=3)
+            if result['failed']:
+                result.update(ok=False, stage='tests')
+        return result
+    finally:
+        result['stdout'] = output.getvalue()[-MAX_OUTPUT:]
+
+def _run_job(job: dict) -> dict:
+    start = time.monotonic()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Only the result pipe stays open; the child must not reach the protocol stream
+        os.closerange(3, write_fd)
+        os.closerange(write_fd + 1, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+        # Own process group, so anything the code spawns is killed with it
+        os.setpgid(0, 0)
+        child = os.getpid()
+        try:
+            _restrict(job)
+            payload = json.dumps(_execute(job))
+        except BaseException:
+            payload = json.dumps({'ok': False, 'stage': 'run', 'error': _short_traceback()})
+        if os.getpid() != child:
+            os._exit(0)  # A process forked by the code; only the child reports
+        with os.fdopen(write_fd, 'w') as pipe:
+            pipe.write(payload)
+        os._exit(0)
+
+    os.close(write_fd)
+    deadline = start + job['timeout']
+    chunks = []
+    timed_out = False
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        ready, _, _ = select.select([read_fd], [], [], remaining)
+        if ready:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    os.close(read_fd)
+    if timed_out:
+        os.kill(pid, signal.SIGKILL)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    _, status = os.waitpid(pid, 0)
+
+    if timed_out:
+        result = {'ok': False, 'stage': 'timeout', 'error': f"Timed out after {job['timeout']}s"}
+    elif chunks:
+        result = json.loads(b''.join(chunks))
+    elif os.WIFSIGNALED(status) and os.WTERMSIG(status) in (signal.SIGXCPU, signal.SIGKILL):
+        result = {'ok': False, 'stage': 'limits', 'error': f"CPU limit of {job['cpu_seconds']}s exceeded"}
+    else:
+        result = {'ok': False, 'stage': 'limits', 'error': f"Process died (status {status})"}
+    result['seconds'] = round(time.monotonic() - start, 4)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--private', action='append', default=[], help="Directory to hide from submitted code")
+    parser.add_argument('--shared-fs', action='store_true', help="The launcher already set up the filesystem")
+    parser.add_argument('--probe', nargs='+', metavar='TOKEN_THEN_DIRS', help="Check isolation and exit")
+    args = parser.parse_args()
+    if not args.shared_fs:
+        _isolate(args.private)
+    if args.probe:
+        token, *checked = args.probe
+        sys.exit(0 if _probe(checked, token) else 1)
+
+    # Keep the protocol stream clean of anything the worker itself might print
+    protocol = os.fdopen(os.dup(1), 'w')
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        try:
+            result = _run_job(json.loads(line))
+        except Exception:
+            result = {'ok': False, 'stage': 'sandbox', 'error': _short_traceback()}
+        protocol.write(json.dumps(result) + '\n')
+        protocol.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import re
+from typing import Dict, List, Optional, Set
+from code_index import get_index
+import logging
+
+logger = logging.getLogger(__name__)
+
+def step_regions(step: str, symbols: Dict[str, int]) -> Optional[Set[int]]:
+    """Top-level statements a plan step refers to, or None if it names none"""
+    names = set(re.findall(r'[A-Za-z_]\w*', step))
+    regions = {symbols[name] for name in names if name in symbols}
+    return regions or None
+
+def plan_batch(plan_steps: List[str], start: int, code: str, max_parallel: int) -> int:
+    """Number of consecutive steps from start that touch disjoint code regions"""
+    if max_parallel <= 1 or start >= len(plan_steps):
+        return 1
+
+    symbols = get_index(code).block_of()
+    claimed: Set[int] = set()
+    size = 0
+    for step in plan_steps[start:start + max_parallel]:
+        regions = step_regions(step, symbols)
+        # Steps with an unknown footprint, or overlapping an earlier one, run alone
+        if regions is None or regions & claimed:
+            break
+        claimed |= regions
+        size += 1
+
+    return max(size, 1)
@@ -1,19 +1,150 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from agent_graph import compiled
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, model_validator
+from agent_graph import get_compiled, close_compiled
+from limits import ConcurrencyLimiter, CapacityError, RateLimiter
+from sandbox import CODE_EXECUTION, get_pool, close_pool, SandboxError
+from tools import llm
+from plan_store import plan_store
+from edit_formats import history as edit_history
+from history import CodeHistory
+from workspace import WorkspaceHistory, file_diff, read
+from inflight import ClientDisconnected, IdempotencyError, InFlightRequests, request_key
+from state import AgentState, as_agent_state
+import speculation
+from sessions import (
+    SessionError, new_session_id, session_config, require_session,
+    rewind, prepare_resume, delete_session
+)
+from metrics import (
+    Gauge, REQUEST_SECONDS, REQUESTS, collect_timings, register,
+    render_metrics, summarize_timings
+)
+from typing import Dict, List, Optional
+import asyncio
+from contextlib import asynccontextmanager
 import logging
 import json
+import os
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class Task(BaseModel):
+    code: str = ""
+    instruction: str
+    files: Optional[Dict[str, str]] = None  # path -> content of a multi-file workspace, instead of code
+    session_id: Optional[str] = None  # Reuse a session ID; a new one is generated otherwise
+    include_timings: bool = False  # Add a per-stage timing breakdown to the response
+    run_code: bool = False  # Run the code in the sandbox after each step
+    tests: Optional[str] = None  # test_* functions that each step must keep passing
+
+    @model_validator(mode='after')
+    def check_files(self):
+        if self.files is None and 'code' not in self.model_fields_set:
+            raise ValueError("Send the code to change, or files for a multi-file task")
+        if self.files is not None:
+            if not self.files:
+                raise ValueError("files must name at least one file")
+            if self.code:
+                raise ValueError("Send either code or files, not both")
+            # The sandbox runs a single module
+            if self.run_code or self.tests:
+                raise ValueError("run_code and tests need a single file (code)")
+        return self
+
+class BatchFile(BaseModel):
+    filename: str
     code: str
+
+class BatchTask(BaseModel):
+    files: List[BatchFile]
     instruction: str
+    shared_plan: bool = True  # Plan once for all files; otherwise each file is planned separately
+    run_code: bool = False
+    tests: Optional[str] = None
+
+class ExecuteRequest(BaseModel):
+    code: str
+    tests: Optional[str] = None
+
+class ResumeRequest(BaseModel):
+    from_step: Optional[int] = None  # Defaults to the step that failed
+    stream: bool = False
+    include_timings: bool = False
+
+class RollbackRequest(BaseModel):
+    version: int  # 0 is the original code, k the code after step k
+
+# Opt-in: one tiny call per LLM client at start-up, and sandbox workers started before first use
+LLM_PREWARM = os.getenv("LLM_PREWARM", "0") == "1"
+SANDBOX_PREWARM = os.getenv("SANDBOX_PREWARM", "0") == "1"
+
+# Seconds each start-up stage took, filled in as they finish
+startup_seconds: Dict[str, float] = {}
+_startup: Optional[asyncio.Task] = None
 
-app = FastAPI()
+async def warm_up():
+    """Compile the graph and build the LLM clients before the first request needs them"""
+    stages = [('graph', get_compiled), ('llm', lambda: llm.start(prewarm=LLM_PREWARM))]
+    if SANDBOX_PREWARM and CODE_EXECUTION:
+        stages.append(('sandbox', get_pool))
+    for name, stage in stages:
+        start = time.perf_counter()
+        try:
+            await stage()
+        except Exception as e:
+            logger.error(f"Start-up failed at {name}: {str(e)}")
+            raise
+        startup_seconds[name] = round(time.perf_counter() - start, 3)
+    logger.info(f"Ready; start-up took {startup_seconds}")
+
+def is_ready() -> bool:
+    return _startup is not None and _startup.done() and not _startup.cancelled() and _startup.exception() is None
+
+register(Gauge("agent_ready", "1 once start-up has finished, 0 before", lambda: int(is_ready())))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start-up runs in the background so the port opens at once; /ready says when it's done.
+    # Requests that arrive earlier wait for whatever they need on their own.
+    global _startup
+    _startup = asyncio.create_task(warm_up())
+    yield
+    if not _startup.done():
+        _startup.cancel()
+    await asyncio.gather(_startup, return_exceptions=True)
+    await close_compiled()
+    await close_pool()
+
+app = FastAPI(lifespan=lifespan)
+
+# Bounded per-process concurrency; excess requests queue until a slot frees up
+agent_limiter = ConcurrencyLimiter(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_AGENTS", "32")),
+    max_queued=int(os.getenv("MAX_QUEUED_AGENTS", "128")),
+    queue_timeout=float(os.getenv("AGENT_QUEUE_TIMEOUT", "60"))
+)
+register(Gauge("agent_active_sessions", "Agent runs currently executing", lambda: agent_limiter.active))
+register(Gauge("agent_queued_sessions", "Agent runs waiting for a slot", lambda: agent_limiter.queued))
+
+# Batch files share the agent limiter; each batch also caps how many of its files are in flight
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Files started per second across all batches (0 = unlimited)
+batch_rate = RateLimiter(
+    rate=float(os.getenv("BATCH_RATE_LIMIT", "0")),
+    burst=int(os.getenv("BATCH_RATE_BURST", "10"))
+)
+
+# Identical /agent and resume requests share one run; stored results answer retries with the same Idempotency-Key
+inflight = InFlightRequests(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "600")),
+    max_results=int(os.getenv("IDEMPOTENCY_MAX_RESULTS", "1024"))
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,111 +155,464 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Longest string logged verbatim; code is summarized by size instead
+MAX_LOGGED_STRING = 200
+
+def summarize_state(value):
+    """Compact, JSON-friendly view of graph state for logging"""
+    if isinstance(value, (CodeHistory, WorkspaceHistory)):
+        return value.summary()
+    if isinstance(value, BaseModel):
+        return {name: summarize_state(getattr(value, name)) for name in type(value).model_fields}
+    if isinstance(value, dict):
+        return {key: summarize_state(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [summarize_state(item) for item in value]
+    if isinstance(value, str) and len(value) > MAX_LOGGED_STRING:
+        return f"<{len(value)} chars>"
+    return value
+
 def log_state(state: dict):
     """Safe state logging that handles non-serializable objects"""
     try:
-        return json.dumps(state, indent=2)
+        return json.dumps(summarize_state(state), indent=2)
     except TypeError:
         # Fallback to string representation
         return str(state)
 
-@app.post('/agent')
-async def run_agent(task: Task):
+async def task_workspace(task: Task) -> Optional[WorkspaceHistory]:
+    """A multi-file task's workspace, its files stored as blobs"""
+    if task.files is None:
+        return None
+    return await asyncio.to_thread(WorkspaceHistory.from_files, task.files)
+
+def build_initial_state(task: Task, workspace: Optional[WorkspaceHistory] = None) -> dict:
+    """Create the initial graph state for a task"""
+    state = {
+        "planner": {
+            "user_task": task.instruction,
+            "plan_steps": [],
+            "planner_done": False,
+            "error": None
+        },
+        "developer": {
+            "plan_steps": [],
+            "current_idx": 0,
+            "code_after": "",
+            "diffs": [],
+            "developer_done": False,
+            "error": None,
+            "run_code": task.run_code,
+            "tests": task.tests
+        },
+        "code_history": [task.code]
+    }
+    # Like code_history, the workspace is replaced, so a reused session starts from this task's files
+    state["workspace"] = workspace if workspace is not None else WorkspaceHistory()
+    return state
+
+def check_state_error(state: AgentState):
+    """Raise if a node reported an error"""
+    for node_state in (state.planner, state.developer):
+        if node_state.error:
+            raise RuntimeError(node_state.error)
+
+def extract_workspace_result(state: AgentState) -> dict:
+    """Plan, changed files and one patch per changed file of a finished multi-file run"""
+    changed = state.workspace.changed_since(0)
+    logger.info(f"Extracted plan: {state.planner.plan_steps}")
+    logger.info(f"Changed files: {sorted(changed)}")
+    if not changed:
+        raise ValueError("Agent didn't produce any code changes")
+    return {
+        'plan': state.planner.plan_steps,
+        'files': {path: new for path, (_, new) in changed.items()},
+        'patches': {path: file_diff(path, old, new) for path, (old, new) in changed.items()},
+        'success': True
+    }
+
+def extract_result(state: AgentState) -> dict:
+    """Plan and final code of a finished run"""
+    if state.workspace:
+        return extract_workspace_result(state)
+    plan = state.planner.plan_steps
+    # code_history[0] is the original code, so a run that changed nothing has one version
+    result = state.developer.code_after or (state.code_history[-1] if len(state.code_history) > 1 else '')
+    
+    logger.info(f"Extracted plan: {plan}")
+    logger.info(f"Extracted result: <{len(result)} chars>")
+    
+    if not result.strip():
+        raise ValueError("Agent didn't produce any code changes")
+    
+    return {
+        'plan': plan,
+        'result': result,
+        'success': True
+    }
+
+async def final_state(compiled, config: dict, values: Optional[dict]) -> AgentState:
+    """The run's last streamed state, or the checkpointed one if nothing ran"""
+    if values is None:
+        values = (await compiled.aget_state(config)).values
+    return as_agent_state(values)
+
+async def run_to_completion(graph_input, session_id: str, include_timings: bool = False,
+                            endpoint: str = 'agent') -> dict:
+    """Run (or continue) a session's graph and return its plan and final code"""
+    config = session_config(session_id)
+    compiled = await get_compiled()
+    values = None
+    start = time.perf_counter()
+    outcome = 'error'
+    
     try:
-        logger.info(f"Received task: {task.instruction}")
+        with collect_timings() as timings, speculation.run_scope(session_id):
+            async with agent_limiter.slot():
+                # Full state after each step: channel values as the nodes left them, nothing rebuilt
+                async for values in compiled.astream(graph_input, config, stream_mode="values"):
+                    logger.info(f"Processing state: {log_state(values)}")
         
-        # Create initial state as a dictionary
-        state = {
-            "planner": {
-                "user_task": task.instruction,
-                "plan_steps": [],
-                "planner_done": False,
-                "error": None
-            },
-            "developer": {
-                "plan_steps": [],
-                "current_idx": 0,
-                "code_after": "",
-                "developer_done": False,
-                "error": None
-            },
-            "code_history": [task.code]
-        }
-        
-        logger.info("Starting agent execution...")
-        logger.info(f"Initial state: {log_state(state)}")
-        
-        # Execute graph
-        last_state = state
-        for event in compiled.stream(state):
-            last_state = event
-            logger.info(f"Processing event: {log_state(event)}")
-            
-            # Safe error checking using dict.get()
-            if last_state.get('planner', {}).get('error'):
-                raise RuntimeError(last_state['planner']['error'])
-            if last_state.get('developer', {}).get('error'):
-                raise RuntimeError(last_state['developer']['error'])
+        # Nothing streamed means nothing was left to run: report the session as it stands
+        state = await final_state(compiled, config, values)
+        check_state_error(state)
         
         logger.info("Agent execution completed successfully")
-        logger.info(f"Final state: {log_state(last_state)}")
+        logger.info(f"Final state: {log_state(state)}")
         
-        # Extract results from the nested state structure
-        # The last_state has format: {'developer': {'planner': PlannerState, 'developer': DeveloperState, 'code_history': [...]}}
-        plan = []
-        result = ''
+        response = {**extract_result(state), 'session_id': session_id}
+        outcome = 'success'
+    except CapacityError:
+        outcome = 'rejected'
+        raise
+    except asyncio.CancelledError:
+        # The session is checkpointed up to the last finished step and can be resumed
+        outcome = 'cancelled'
+        logger.info(f"Run for session {session_id} cancelled")
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+    
+    if include_timings:
+        response['timings'] = {'total_seconds': round(elapsed, 6), 'spans': summarize_timings(timings)}
+    return response
+
+async def client_disconnected(request: Request):
+    """Return once the client has closed the connection"""
+    # The body has been read by now, so the next message is the disconnect
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
+
+async def shared_run(fingerprint: str, idempotency_key: Optional[str], start, request: Request) -> dict:
+    """Result of start(), shared with identical requests in flight and cancelled once all their clients leave"""
+    key = f"idempotency:{idempotency_key}" if idempotency_key else fingerprint
+    try:
+        return await inflight.run(
+            key, fingerprint, start, lambda: client_disconnected(request),
+            remember=idempotency_key is not None
+        )
+    except IdempotencyError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ClientDisconnected as e:
+        # Nobody reads this; it only shows up in the access log
+        raise HTTPException(status_code=499, detail=str(e))
+
+async def execute_agent(task: Task) -> dict:
+    session_id = task.session_id or new_session_id()
+    try:
+        logger.info(f"Received task: {task.instruction} (session {session_id})")
         
-        # Get the innermost state based on which node ran last
-        if 'developer' in last_state and 'planner' in last_state['developer']:
-            # Extract from developer event
-            inner_state = last_state['developer']
-            planner_obj = inner_state['planner']
-            developer_obj = inner_state['developer']
-            
-            # Extract plan from planner object
-            if hasattr(planner_obj, 'plan_steps'):
-                plan = planner_obj.plan_steps
-            
-            # Extract result from developer object
-            if hasattr(developer_obj, 'code_after'):
-                result = developer_obj.code_after
-                
-        elif 'planner' in last_state and 'planner' in last_state['planner']:
-            # Extract from planner event
-            inner_state = last_state['planner']
-            planner_obj = inner_state['planner']
-            
-            if hasattr(planner_obj, 'plan_steps'):
-                plan = planner_obj.plan_steps
+        state = build_initial_state(task, await task_workspace(task))
         
-        logger.info(f"Extracted plan: {plan}")
-        logger.info(f"Extracted result: '{result}'")
+        logger.info("Starting agent execution...")
+        logger.info(f"Initial state: {log_state(state)}")
         
-        # Check if we have valid results
-        if not result or result.strip() == '':
-            # Try to get from code_history as fallback
-            code_history = []
-            if 'developer' in last_state:
-                code_history = last_state['developer'].get('code_history', [])
-            elif 'planner' in last_state:
-                code_history = last_state['planner'].get('code_history', [])
+        return await run_to_completion(state, session_id, task.include_timings)
+    
+    except CapacityError as e:
+        logger.warning(f"Rejected task: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        # The session is checkpointed up to the failure, so the client can resume it
+        raise HTTPException(status_code=500, detail=str(e), headers={'X-Session-Id': session_id})
+
+def require_execution(run_code: bool, tests: Optional[str]):
+    """Refuse requests that would run their code in the sandbox unless execution is enabled"""
+    # The caller's own code runs before any LLM call, so this is as open as POST /execute
+    if (run_code or tests) and not CODE_EXECUTION:
+        raise HTTPException(status_code=403, detail="run_code and tests are disabled (set ENABLE_CODE_EXECUTION=1)")
+
+@app.post('/agent')
+async def run_agent(task: Task, request: Request, idempotency_key: Optional[str] = Header(None)):
+    require_execution(task.run_code, task.tests)
+    fingerprint = request_key('agent', task.model_dump_json())
+    return await shared_run(fingerprint, idempotency_key, lambda: execute_agent(task), request)
+
+async def stream_events(graph_input, session_id: str, steps_sent: int = 0,
+                        include_timings: bool = False):
+    """Translate graph events into NDJSON progress messages"""
+    plan_sent = False
+    values = None
+    config = session_config(session_id)
+    start = time.perf_counter()
+    outcome = 'error'
+    timing_scope = collect_timings()
+    timings = timing_scope.__enter__()
+    draft_scope = speculation.run_scope(session_id)
+    draft_scope.__enter__()
+    
+    try:
+        compiled = await get_compiled()
+        yield {'type': 'session', 'session_id': session_id}
+        async with agent_limiter.slot():
+            async for values in compiled.astream(graph_input, config, stream_mode="values"):
+                state = as_agent_state(values)
+                check_state_error(state)
+                
+                if state.planner.planner_done and not plan_sent:
+                    plan_sent = True
+                    yield {'type': 'plan', 'plan': state.planner.plan_steps}
                 
-            if code_history and len(code_history) > 1:  # More than just the initial code
-                result = code_history[-1]  # Get the last version
-                logger.info(f"Using code_history fallback: '{result}'")
-            
-            if not result or result.strip() == '':
-                raise ValueError("Agent didn't produce any code changes")
+                # code_history[0] is the original code, so step i produced code_history[i + 1]
+                diffs = state.developer.diffs
+                for i in range(steps_sent, len(diffs)):
+                    if state.workspace:
+                        # Each workspace step changed one file
+                        path, key = next(iter(state.workspace.changes[i].items()))
+                        yield {
+                            'type': 'step',
+                            'index': i,
+                            'step': state.planner.plan_steps[i] if i < len(state.planner.plan_steps) else '',
+                            'file': path,
+                            'diff': diffs[i],
+                            'code': read(state.workspace.tree(i + 1), path)
+                        }
+                        continue
+                    yield {
+                        'type': 'step',
+                        'index': i,
+                        'step': state.planner.plan_steps[i] if i < len(state.planner.plan_steps) else '',
+                        'diff': diffs[i],
+                        'code': state.code_history[i + 1] if i + 1 < len(state.code_history) else state.developer.code_after
+                    }
+                steps_sent = max(steps_sent, len(diffs))
         
-        return {
-            'plan': plan,
-            'result': result,
-            'success': True
-        }
+        state = await final_state(compiled, config, values)
+        check_state_error(state)
+        done = {'type': 'done', **extract_result(state), 'session_id': session_id}
+        outcome = 'success'
+        if include_timings:
+            done['timings'] = {
+                'total_seconds': round(time.perf_counter() - start, 6),
+                'spans': summarize_timings(timings)
+            }
+        yield done
     
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        outcome = 'rejected' if isinstance(e, CapacityError) else 'error'
+        logger.error(f"Error streaming request: {str(e)}", exc_info=True)
+        yield {'type': 'error', 'detail': str(e), 'success': False, 'session_id': session_id}
+    
+    finally:
+        # Set and reset inside this generator, so neither scope leaks into the caller; ending
+        # the run also cancels the drafts it left unclaimed, however the stream stopped
+        draft_scope.__exit__(None, None, None)
+        timing_scope.__exit__(None, None, None)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint='agent_stream')
+        REQUESTS.inc(endpoint='agent_stream', outcome=outcome)
+
+def ndjson_response(messages) -> StreamingResponse:
+    # The agent slot is taken inside the generator so it is always released with it
+    lines = (json.dumps(message) + '\n' async for message in messages)
+    return StreamingResponse(lines, media_type='application/x-ndjson')
+
+@app.post('/agent/stream')
+async def stream_agent(task: Task):
+    """Stream plan and per-step results as newline-delimited JSON"""
+    require_execution(task.run_code, task.tests)
+    session_id = task.session_id or new_session_id()
+    logger.info(f"Received streaming task: {task.instruction} (session {session_id})")
+    state = build_initial_state(task, await task_workspace(task))
+    return ndjson_response(stream_events(state, session_id, include_timings=task.include_timings))
+
+async def run_batch_file(index: int, file: BatchFile, task: BatchTask, plan: List[str],
+                         semaphore: asyncio.Semaphore) -> dict:
+    """Run one file of a batch as its own session; failures are reported, not raised"""
+    session_id = new_session_id()
+    async with semaphore:
+        await batch_rate.acquire()
+        state = build_initial_state(Task(
+            code=file.code, instruction=task.instruction, run_code=task.run_code, tests=task.tests
+        ))
+        if plan:
+            # The planner passes a prefilled plan straight through to the developer
+            state['planner']['plan_steps'] = plan
+            state['developer']['plan_steps'] = plan
+        try:
+            result = await run_to_completion(state, session_id, endpoint='batch')
+        except Exception as e:
+            logger.warning(f"Batch file {file.filename} failed: {str(e)}")
+            result = {'success': False, 'detail': str(e), 'session_id': session_id}
+    return {'type': 'file', 'index': index, 'filename': file.filename, **result}
+
+async def batch_events(task: BatchTask):
+    """Plan once, run every file concurrently and report each file as it finishes"""
+    start = time.perf_counter()
+    plan = []
+    if task.shared_plan:
+        try:
+            from planner import plan_shared  # Loaded with the graph at start-up
+            plan = await plan_shared(task.instruction, [(f.filename, f.code) for f in task.files])
+        except Exception as e:
+            logger.warning(f"Shared planning failed, planning per file: {str(e)}")
+    # An empty plan means every file is planned on its own
+    yield {'type': 'plan', 'plan': plan, 'shared': bool(plan)}
+    
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    pending = [
+        asyncio.ensure_future(run_batch_file(i, file, task, plan, semaphore))
+        for i, file in enumerate(task.files)
+    ]
+    succeeded = 0
+    try:
+        for next_done in asyncio.as_completed(pending):
+            result = await next_done
+            succeeded += bool(result.get('success'))
+            yield result
+    finally:
+        # The client went away or the stream failed: stop the remaining files
+        for future in pending:
+            future.cancel()
+    
+    yield {
+        'type': 'done',
+        'files': len(task.files),
+        'succeeded': succeeded,
+        'failed': len(task.files) - succeeded,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+@app.post('/agent/batch')
+async def run_batch(task: BatchTask):
+    """Apply one instruction to many files, streaming each file's result as NDJSON"""
+    if not task.files:
+        raise HTTPException(status_code=400, detail="No files given")
+    if len(task.files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files per batch")
+    require_execution(task.run_code, task.tests)
+    logger.info(f"Received batch task for {len(task.files)} files: {task.instruction}")
+    return ndjson_response(batch_events(task))
+
+def session_summary(session_id: str, state) -> dict:
+    return {
+        'session_id': session_id,
+        'task': state.planner.user_task,
+        'plan': state.planner.plan_steps,
+        'current_step': state.developer.current_idx,
+        'done': state.developer.developer_done,
+        'error': state.planner.error or state.developer.error,
+        'versions': state.version_count()
+    }
+
+@app.get('/sessions/{session_id}')
+async def get_session(session_id: str):
+    try:
+        return session_summary(session_id, await require_session(session_id))
+    except SessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get('/sessions/{session_id}/versions/{version}')
+async def get_session_version(session_id: str, version: int):
+    try:
+        state = await require_session(session_id)
+        if state.workspace:
+            return {'session_id': session_id, 'version': version, 'files': state.workspace.files(version)}
+        return {'session_id': session_id, 'version': version, 'code': state.code_history[version]}
+    except SessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+async def stream_resume(session_id: str, request: ResumeRequest):
+    try:
+        graph_input = await prepare_resume(session_id, request.from_step)
+        state = await require_session(session_id)
+        return ndjson_response(stream_events(
+            graph_input, session_id, len(state.developer.diffs), request.include_timings
+        ))
+    except SessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error resuming session {session_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e), headers={'X-Session-Id': session_id})
+
+async def execute_resume(session_id: str, request: ResumeRequest) -> dict:
+    try:
+        graph_input = await prepare_resume(session_id, request.from_step)
+        return await run_to_completion(graph_input, session_id, request.include_timings, endpoint='resume')
+    except SessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except CapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error resuming session {session_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e), headers={'X-Session-Id': session_id})
+
+@app.post('/sessions/{session_id}/resume')
+async def resume_session(session_id: str, http_request: Request, request: Optional[ResumeRequest] = None,
+                         idempotency_key: Optional[str] = Header(None)):
+    """Continue a session from its failed step, or retry from an earlier one"""
+    request = request or ResumeRequest()
+    if request.stream:
+        return await stream_resume(session_id, request)
+    fingerprint = request_key('resume', session_id, request.model_dump_json())
+    return await shared_run(fingerprint, idempotency_key, lambda: execute_resume(session_id, request), http_request)
+
+@app.post('/sessions/{session_id}/rollback')
+async def rollback_session(session_id: str, request: RollbackRequest):
+    """Roll a session back to an earlier code version without re-running anything"""
+    try:
+        state = await rewind(session_id, request.version)
+        if state.workspace:
+            return {**session_summary(session_id, state), 'files': state.workspace.files()}
+        return {**session_summary(session_id, state), 'code': state.code_history[-1]}
+    except SessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.delete('/sessions/{session_id}')
+async def remove_session(session_id: str):
+    await delete_session(session_id)
+    return {'session_id': session_id, 'deleted': True}
+
+@app.post('/execute')
+async def execute(request: ExecuteRequest):
+    """Run code (and optional test_* functions) in the server-side sandbox"""
+    if not CODE_EXECUTION:
+        raise HTTPException(status_code=403, detail="POST /execute is disabled (set ENABLE_CODE_EXECUTION=1)")
+    try:
+        pool = await get_pool()
+    except SandboxError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    result = await pool.run(request.code, request.tests)
+    return result.model_dump()
+
+@app.get('/metrics')
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+# Readiness: unlike the health check, fails until start-up has finished
+@app.get("/ready")
+async def readiness_check():
+    if _startup is None or not _startup.done():
+        raise HTTPException(status_code=503, detail="Starting up")
+    if _startup.cancelled() or _startup.exception() is not None:
+        error = "cancelled" if _startup.cancelled() else str(_startup.exception())
+        raise HTTPException(status_code=503, detail=f"Start-up failed: {error}")
+    return {"status": "ready", "startup_seconds": startup_seconds}
 
 # Health check endpoint
 @app.get("/")
@@ -136,5 +620,11 @@ async def health_check():
     return {
         "status": "running",
         "service": "Python Agent Server",
-        "version": "1.0"
+        "version": "1.0",
+        "active_agents": agent_limiter.active,
+        "queued_agents": agent_limiter.queued,
+        "llm": llm.stats(),
+        "requests": inflight.stats(),
+        "plan_store": plan_store.stats() if plan_store is not None else None,
+        "edit_formats": edit_history.stats()
     }
\ No newline at end of file
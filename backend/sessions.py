@@ -0,0 +1,92 @@
+import uuid
+from typing import Optional
+from agent_graph import get_compiled
+from state import AgentState, as_agent_state
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SessionError(Exception):
+    """Raised for unknown sessions or invalid session operations"""
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+def session_config(session_id: str) -> dict:
+    return {"configurable": {"thread_id": session_id}}
+
+async def load_session(session_id: str) -> Optional[AgentState]:
+    """Latest checkpointed state of a session, or None if it doesn't exist"""
+    compiled = await get_compiled()
+    snapshot = await compiled.aget_state(session_config(session_id))
+    if not snapshot.values:
+        return None
+    return as_agent_state(snapshot.values)
+
+async def require_session(session_id: str) -> AgentState:
+    state = await load_session(session_id)
+    if state is None:
+        raise SessionError(f"Unknown session '{session_id}'")
+    return state
+
+async def rewind(session_id: str, version: int) -> AgentState:
+    """Roll a session back to code version `version` (0 is the original code)"""
+    # Version k is the code after plan step k, so developer progress goes back to step k too
+    state = await require_session(session_id)
+    count = state.version_count()
+    if not 0 <= version < count:
+        raise SessionError(f"Version {version} out of range (session has {count})")
+
+    if state.workspace:
+        # Multi-file sessions keep their versions in the workspace; code_after is unused there
+        rolled_back = {'workspace': state.workspace.truncated(version + 1)}
+        code_after = ""
+    else:
+        rolled_back = {'code_history': state.code_history.truncated(version + 1)}
+        code_after = rolled_back['code_history'][-1] if version else ""
+    developer = state.developer.model_copy(update={
+        'current_idx': version,
+        'code_after': code_after,
+        'diffs': state.developer.diffs[:version],
+        'developer_done': version >= len(state.planner.plan_steps),
+        'error': None
+    })
+    # Written as if by the planner, so the next run continues with the developer
+    compiled = await get_compiled()
+    await compiled.aupdate_state(
+        session_config(session_id),
+        {'developer': developer, **rolled_back},
+        as_node='planner'
+    )
+    logger.info(f"Session {session_id} rolled back to version {version}")
+    return state.model_copy(update={'developer': developer, **rolled_back})
+
+async def prepare_resume(session_id: str, from_step: Optional[int] = None) -> Optional[dict]:
+    """Set a session up to continue from a step; returns the graph input to run with"""
+    state = await require_session(session_id)
+
+    if state.planner.error or not state.planner.plan_steps:
+        # Nothing reusable yet: plan again from the original code
+        logger.info(f"Session {session_id} has no plan, restarting it")
+        restart = {
+            'planner': {'user_task': state.planner.user_task},
+            'developer': {'run_code': state.developer.run_code, 'tests': state.developer.tests},
+            'code_history': [state.code_history[0]]
+        }
+        if state.workspace:
+            restart['workspace'] = state.workspace.truncated(1)
+        return restart
+
+    step = state.developer.current_idx if from_step is None else from_step
+    if not 0 <= step <= len(state.planner.plan_steps):
+        raise SessionError(f"Step {step} out of range (plan has {len(state.planner.plan_steps)})")
+    if step > state.version_count() - 1:
+        raise SessionError(f"Step {step} has not been reached yet")
+
+    await rewind(session_id, step)
+    # None tells the graph to continue from the checkpoint
+    return None
+
+async def delete_session(session_id: str):
+    compiled = await get_compiled()
+    await compiled.checkpointer.adelete_thread(session_id)
@@ -0,0 +1,71 @@
+import asyncio
+import contextvars
+import hashlib
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Optional, Tuple
+from metrics import SPECULATIVE_DRAFTS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Unclaimed drafts kept before the oldest is cancelled
+MAX_PENDING_DRAFTS = 64
+
+RunId = Optional[Tuple[str, int]]
+
+_drafts: "OrderedDict[Tuple[RunId, str, str], asyncio.Future]" = OrderedDict()
+
+# The graph run drafts belong to, set by the server around each run's graph stream
+_run: contextvars.ContextVar[RunId] = contextvars.ContextVar("speculation_run", default=None)
+_run_numbers = itertools.count()
+
+def _key(code: str, step: str) -> Tuple[RunId, str, str]:
+    return _run.get(), hashlib.sha1(code.encode('utf-8')).hexdigest(), step
+
+def _cancel(keys):
+    for key in keys:
+        _drafts.pop(key).cancel()
+        SPECULATIVE_DRAFTS.inc(outcome="discarded")
+
+@contextmanager
+def run_scope(session_id: str):
+    """Scope drafts to one run of a session's graph; whatever it left unclaimed is cancelled at the end"""
+    # Numbered too, so two runs of the same session never share or cancel each other's drafts
+    run = (session_id, next(_run_numbers))
+    token = _run.set(run)
+    try:
+        yield
+    finally:
+        _cancel([key for key in _drafts if key[0] == run])
+        _run.reset(token)
+
+def _retrieve(future: asyncio.Future):
+    # Failed drafts that nobody claims must not log "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+def dispatch(code: str, step: str, draft: Awaitable):
+    """Start drafting a step against the code it was planned for, before the plan is final"""
+    key = _key(code, step)
+    if key in _drafts:
+        # Already drafting this step for this code in this run
+        if asyncio.iscoroutine(draft):
+            draft.close()
+        return
+    future = asyncio.ensure_future(draft)
+    future.add_done_callback(_retrieve)
+    _drafts[key] = future
+    if len(_drafts) > MAX_PENDING_DRAFTS:
+        _cancel(list(_drafts)[:len(_drafts) - MAX_PENDING_DRAFTS])
+    logger.info(f"Speculatively drafting step: {step}")
+
+def claim(code: str, step: str) -> Optional[asyncio.Future]:
+    """The draft started for this step of a plan made against code, if any"""
+    return _drafts.pop(_key(code, step), None)
+
+def discard(code: str):
+    """Cancel every unclaimed draft this run made against code"""
+    run, digest, _ = _key(code, "")
+    _cancel([key for key in _drafts if key[:2] == (run, digest)])
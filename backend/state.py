@@ -1,6 +1,8 @@
 # state.py
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Annotated, List, Optional
+from history import CodeHistory, merge_history
+from workspace import WorkspaceHistory, merge_workspace
 
 class PlannerState(BaseModel):
     user_task: str
@@ -12,10 +14,23 @@ class DeveloperState(BaseModel):
     plan_steps: List[str] = []
     current_idx: int = 0
     code_after: str = ""
+    diffs: List[str] = []  # One applied diff per completed step
+    run_code: bool = False  # Execute the code in the sandbox after each step
+    tests: Optional[str] = None  # test_* functions run in the sandbox after each step
     developer_done: bool = False
     error: Optional[str] = None
 
 class AgentState(BaseModel):
+    # Nodes return only the fields they change; code_history grows through its reducer
     planner: PlannerState
     developer: DeveloperState
-    code_history: List[str] = []
\ No newline at end of file
+    code_history: Annotated[CodeHistory, merge_history] = CodeHistory()
+    # Multi-file runs keep their files here instead, and code_history stays at one empty version
+    workspace: Annotated[WorkspaceHistory, merge_workspace] = WorkspaceHistory()
+
+    def version_count(self) -> int:
+        return len(self.workspace) or len(self.code_history)
+
+def as_agent_state(values) -> AgentState:
+    """Typed view of graph state values, e.g. a checkpoint snapshot or a stream_mode='values' event"""
+    return values if isinstance(values, AgentState) else AgentState.model_validate(values)
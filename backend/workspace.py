@@ -0,0 +1,222 @@
+import difflib
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+from pydantic import BaseModel
+from code_index import get_index
+import logging
+
+logger = logging.getLogger(__name__)
+
+# File contents are stored once per distinct content; "memory" keeps them in this process only
+BLOB_DB = os.getenv("WORKSPACE_BLOB_DB", "blobs.sqlite3")
+# Decoded blobs kept in memory in front of the database
+BLOB_CACHE_CHARS = int(os.getenv("WORKSPACE_BLOB_CACHE_CHARS", "64000000"))
+# Per-blob symbol name sets kept for ranking files
+MAX_INDEXED_BLOBS = 4096
+
+Tree = Dict[str, str]  # path -> blob hash
+
+def blob_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+class BlobStore:
+    """Content-addressed file contents, shared by every version and session that holds them"""
+
+    def __init__(self, path: Optional[str] = None, max_cached_chars: int = BLOB_CACHE_CHARS):
+        self.path = path
+        self.max_cached_chars = max_cached_chars
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cached_chars = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, content TEXT NOT NULL)")
+            self._conn.commit()
+
+    def _remember(self, key: str, content: str):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return
+        self._cache[key] = content
+        self._cached_chars += len(content)
+        if self._conn is None:
+            return  # The cache is the only copy
+        while self._cached_chars > self.max_cached_chars and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_chars -= len(evicted)
+
+    def put_many(self, contents: Iterable[str]) -> List[str]:
+        """Store contents, returning their hashes; content already stored costs nothing"""
+        hashes = []
+        new: Dict[str, str] = {}
+        for content in contents:
+            key = blob_hash(content)
+            hashes.append(key)
+            new[key] = content
+        with self._lock:
+            for key, content in new.items():
+                self._remember(key, content)
+            if self._conn is not None:
+                self._conn.executemany("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", new.items())
+                self._conn.commit()
+        return hashes
+
+    def put(self, content: str) -> str:
+        return self.put_many([content])[0]
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            content = self._cache.get(key)
+            if content is not None:
+                self._cache.move_to_end(key)
+                return content
+            if self._conn is not None:
+                row = self._conn.execute("SELECT content FROM blobs WHERE hash = ?", (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    return row[0]
+        raise KeyError(f"Unknown blob {key[:12]}")
+
+    def stats(self) -> dict:
+        return {'cached_blobs': len(self._cache), 'cached_chars': self._cached_chars}
+
+_store: Optional[BlobStore] = None
+_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    """The process-wide blob store, opened on first use"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BlobStore(None if BLOB_DB == "memory" else BLOB_DB)
+    return _store
+
+def read(tree: Tree, path: str) -> str:
+    """Content of a file in a tree; files a step creates start out empty"""
+    return get_blob_store().get(tree[path]) if path in tree else ""
+
+class WorkspaceHistory(BaseModel):
+    """Versions of a multi-file workspace: the first tree in full, then the files each version changed
+
+    Trees map paths to blob hashes, so a version costs one entry per file it touched,
+    and a file's content is stored once however many versions and sessions share it.
+    An empty history means the run works on a single file (code_history) instead.
+    """
+    base: Tree = {}
+    changes: List[Tree] = []  # changes[k] turns version k into version k + 1
+
+    @classmethod
+    def from_files(cls, files: Dict[str, str]) -> "WorkspaceHistory":
+        paths = sorted(files)
+        hashes = get_blob_store().put_many(files[path] for path in paths)
+        return cls(base=dict(zip(paths, hashes)))
+
+    def __len__(self) -> int:
+        return len(self.changes) + 1 if self.base else 0
+
+    def tree(self, version: int = -1) -> Tree:
+        count = len(self)
+        if version < 0:
+            version += count
+        if not 0 <= version < count:
+            raise IndexError(f"Version {version} out of range (workspace has {count})")
+        tree = dict(self.base)
+        for changed in self.changes[:version]:
+            tree.update(changed)
+        return tree
+
+    def files(self, version: int = -1) -> Dict[str, str]:
+        return {path: read(self.tree(version), path) for path in self.tree(version)}
+
+    def changed_since(self, version: int = 0) -> Dict[str, Tuple[str, str]]:
+        """path -> (content at version, current content) for every file changed after version"""
+        old, new = self.tree(version), self.tree()
+        return {
+            path: (read(old, path), read(new, path))
+            for path in sorted(new) if old.get(path) != new[path]
+        }
+
+    def truncated(self, count: int) -> "WorkspaceHistory":
+        """History holding only the first count versions"""
+        if not 1 <= count <= len(self):
+            raise IndexError(f"Cannot keep {count} of {len(self)} versions")
+        return WorkspaceHistory.model_construct(base=self.base, changes=self.changes[:count - 1])
+
+    def summary(self) -> str:
+        if not self:
+            return "<no workspace>"
+        return f"<{len(self)} versions of {len(self.tree())} files>"
+
+class WorkspaceChanges(BaseModel):
+    """Versions to append to the workspace channel, as the files each one changed (see merge_workspace)"""
+    changes: List[Tree]
+
+def merge_workspace(workspace: WorkspaceHistory, update: Union[WorkspaceChanges, WorkspaceHistory, dict]) -> WorkspaceHistory:
+    """Reducer for the workspace channel: WorkspaceChanges are appended, anything else replaces it"""
+    if isinstance(update, WorkspaceChanges):
+        workspace = WorkspaceHistory.model_validate(workspace)
+        return WorkspaceHistory.model_construct(base=workspace.base, changes=workspace.changes + update.changes)
+    # Graph input and rollbacks set the whole history
+    return WorkspaceHistory.model_validate(update)
+
+def file_diff(path: str, old: str, new: str) -> str:
+    """Unified diff of one file, with a/ and b/ path headers"""
+    return "".join(difflib.unified_diff(
+        old.splitlines(keepends=True), new.splitlines(keepends=True),
+        fromfile=f"a/{path}" if old else "/dev/null", tofile=f"b/{path}"
+    ))
+
+def query_terms(text: str) -> FrozenSet[str]:
+    # As in CodeIndex.search: identifiers and words of three or more characters
+    return frozenset(term.lower() for term in re.findall(r'[A-Za-z_]\w*', text) if len(term) > 2)
+
+_names: "OrderedDict[str, FrozenSet[str]]" = OrderedDict()
+_names_lock = threading.Lock()
+
+def defined_names(key: str) -> FrozenSet[str]:
+    """Lowercased names a blob defines; keyed by content, so never stale and shared across versions"""
+    with _names_lock:
+        names = _names.get(key)
+        if names is not None:
+            _names.move_to_end(key)
+            return names
+    names = frozenset(symbol.name.lower() for symbol in get_index(get_blob_store().get(key)).symbols)
+    with _names_lock:
+        _names[key] = names
+        while len(_names) > MAX_INDEXED_BLOBS:
+            _names.popitem(last=False)
+    return names
+
+def rank_files(tree: Tree, query: str) -> List[str]:
+    """Paths relevant to a query, best first: files it names, then files defining what it names"""
+    terms = query_terms(query)
+    lowered = query.lower()
+    scored = []
+    for path, key in tree.items():
+        score = 10 if path.lower() in lowered else 0
+        # Only the file's own name: directories many files share say little about any of them
+        score += 2 * len(terms & query_terms(os.path.splitext(os.path.basename(path))[0]))
+        score += 3 * len(terms & defined_names(key))
+        if score:
+            scored.append((-score, path))
+    return [path for _, path in sorted(scored)]
+
+def step_target(step: str, tree: Tree) -> Optional[str]:
+    """The file a plan step changes: the path it starts with or mentions, else the best-ranked file"""
+    match = re.match(r'\s*`?([\w./-]+\.\w+)`?\s*:', step)
+    if match:
+        return match.group(1)
+    for path in sorted(tree, key=len, reverse=True):
+        if path in step:
+            return path
+    ranked = rank_files(tree, step)
+    if ranked:
+        return ranked[0]
+    return next(iter(tree)) if len(tree) == 1 else None
@@ -4,7 +4,7 @@ import Toolbar from './components/Toolbar';
 import AgentPanel from './components/AgentPanel';
 import OutputPane from './components/OutputPane';
 import { runPython } from './utils/pyodideRunner';
-import { callAgent } from './utils/agentClient';  // Import your existing client
+import { streamAgent } from './utils/agentClient';
 
 export default function App() {
   const [code, setCode] = useState('# Write Python here');
@@ -29,9 +29,19 @@ export default function App() {
     setLoading(true);
     setOutput('Generating explanation...');
     try {
-      const { result, plan } = await callAgent(code, 'Explain and improve this code');
+      // Show the plan and each step's code as soon as the agent produces them
+      let plan = [];
+      const { result } = await streamAgent(code, 'Explain and improve this code', (message) => {
+        if (message.type === 'plan') {
+          plan = message.plan || [];
+          setOutput(`Plan:\n${plan.join('\n')}`);
+        } else if (message.type === 'step') {
+          setCode(message.code);
+          setOutput(`Plan:\n${plan.join('\n')}\n\nApplied step ${message.index + 1} of ${plan.length}`);
+        }
+      });
       setCode(result);
-      setOutput(plan?.join('\n') || 'Explanation generated');
+      setOutput(plan.join('\n') || 'Explanation generated');
     } catch (err) {
       setOutput(`Error: ${err.message}`);
     } finally {
@@ -1,5 +1,5 @@
 import React, { useState } from 'react';
-import { callAgent } from '../utils/agentClient';
+import { streamAgent } from '../utils/agentClient';
 
 export default function AgentPanel({ code, onExplain, loading: parentLoading }) {
   const [plan, setPlan] = useState([]);
@@ -20,9 +20,13 @@ export default function AgentPanel({ code, onExplain, loading: parentLoading })
     setPlan([]);
     
     try {
-      const response = await callAgent(
+      // The plan is listed as soon as it streams in, before any step has run
+      const response = await streamAgent(
         code, 
-        'Explain this Python code and suggest improvements'
+        'Explain this Python code and suggest improvements',
+        (message) => {
+          if (message.type === 'plan') setPlan(message.plan || []);
+        }
       );
       
       if (!response || !response.result) {
@@ -19,4 +19,51 @@ export async function callAgent(code, instruction) {
     console.error("API Call Failed:", error);
     throw error;
   }
-}
\ No newline at end of file
+}
+
+// Streams agent progress from /agent/stream, calling onEvent for every
+// NDJSON message ({type: 'plan' | 'step' | 'done' | 'error', ...}).
+// Resolves with the final 'done' message.
+export async function streamAgent(code, instruction, onEvent) {
+  const res = await fetch('/api/agent/stream', {
+    method: 'POST',
+    headers: {'Content-Type':'application/json'},
+    body: JSON.stringify({ code, instruction })
+  });
+
+  if (!res.ok) {
+    throw new Error(`API Error: ${res.status} ${res.statusText}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let final = null;
+
+  const handleLine = (line) => {
+    if (!line.trim()) return;
+    const message = JSON.parse(line);
+    if (onEvent) onEvent(message);
+    if (message.type === 'error') {
+      throw new Error(message.detail);
+    }
+    if (message.type === 'done') {
+      final = message;
+    }
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    lines.forEach(handleLine);
+  }
+  handleLine(buffer);
+
+  if (!final) {
+    throw new Error('Agent stream ended without a result');
+  }
+  return final;
+}